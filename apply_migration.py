@@ -3,10 +3,15 @@
 Script to apply the Amazon product data migration
 """
 
-import duckdb
 import os
+import sys
 from pathlib import Path
 
+# Add the backend directory to the Python path
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+
+from app.duckdb_utils import write_connection
+
 def apply_migration():
     """Apply the Amazon product data migration"""
     
@@ -29,53 +34,57 @@ def apply_migration():
     ALTER TABLE washing_machines ADD COLUMN IF NOT EXISTS amazon_last_checked TIMESTAMP;
     ALTER TABLE washing_machines ADD COLUMN IF NOT EXISTS amazon_product_title TEXT;
     
-    -- Create indexes for better performance (ignore if they exist)
-    CREATE INDEX IF NOT EXISTS idx_washing_machines_amazon_asin ON washing_machines(amazon_asin);
-    CREATE INDEX IF NOT EXISTS idx_washing_machines_amazon_last_checked ON washing_machines(amazon_last_checked);
-    
     -- Add local image path column
     ALTER TABLE washing_machines ADD COLUMN IF NOT EXISTS local_image_path TEXT;
+    
+    -- Lowercased copies of the free-text search columns (plain substring match instead of ILIKE)
+    ALTER TABLE washing_machines ADD COLUMN IF NOT EXISTS nom_modele_lc VARCHAR;
+    ALTER TABLE washing_machines ADD COLUMN IF NOT EXISTS nom_metteur_sur_le_marche_lc VARCHAR;
+    UPDATE washing_machines SET nom_modele_lc = lower(nom_modele),
+                                nom_metteur_sur_le_marche_lc = lower(nom_metteur_sur_le_marche);
+    
+    -- Index the ASIN used for joins (ignore if it exists); amazon_last_checked is too
+    -- low-selectivity for an ART index to pay off, so drop it if a previous run created it
+    CREATE INDEX IF NOT EXISTS idx_washing_machines_amazon_asin ON washing_machines(amazon_asin);
+    DROP INDEX IF EXISTS idx_washing_machines_amazon_last_checked;
+    
+    -- No search filter can use an ART index on brand (substring match) or on
+    -- date_calcul (year-wide range); zone maps prune those, so drop them if a previous run created them
+    DROP INDEX IF EXISTS idx_wm_brand;
+    DROP INDEX IF EXISTS idx_wm_year_rep;
     """
     
     try:
         print("🔧 Applying Amazon product data migration...")
         print(f"📁 Database: {db_path}")
         
-        # Connect to database
-        conn = duckdb.connect(db_path)
-        
-        # Check current table structure
-        print("\n📊 Current table structure:")
-        result = conn.execute("PRAGMA table_info(washing_machines)").fetchall()
-        columns = [row[1] for row in result]
-        print(f"   Found {len(columns)} columns")
-        
-        # Check if Amazon columns already exist
-        amazon_columns = ['amazon_asin', 'amazon_product_url', 'amazon_image_url', 
-                         'amazon_price_eur', 'amazon_last_checked', 'amazon_product_title']
-        
-        existing_amazon_columns = [col for col in amazon_columns if col in columns]
-        if existing_amazon_columns:
-            print(f"   ⚠️  Some Amazon columns already exist: {existing_amazon_columns}")
-        
-        # Apply migration
-        print("\n🚀 Applying migration...")
-        conn.execute(migration_sql)
+        # Migrate a copy that replaces the file when done, so it works while the API
+        # holds the database open
+        with write_connection(db_path) as conn:
+            amazon_columns = ['amazon_asin', 'amazon_product_url', 'amazon_image_url', 
+                             'amazon_price_eur', 'amazon_last_checked', 'amazon_product_title']
         
-        # Verify the changes
-        print("\n✅ Migration completed! New table structure:")
-        result = conn.execute("PRAGMA table_info(washing_machines)").fetchall()
-        new_columns = [row[1] for row in result]
+            # Apply migration; IF NOT EXISTS keeps it idempotent, one transaction means one catalog commit
+            print("\n🚀 Applying migration...")
+            conn.begin()
+            try:
+                conn.execute(migration_sql)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
         
-        # Show new Amazon columns
-        new_amazon_columns = [col for col in amazon_columns if col in new_columns]
-        print(f"   Amazon columns: {new_amazon_columns}")
+            # Verify the changes
+            print("\n✅ Migration completed! New table structure:")
+            result = conn.execute("PRAGMA table_info(washing_machines)").fetchall()
+            new_columns = [row[1] for row in result]
         
-        # Check total columns
-        print(f"   Total columns: {len(new_columns)}")
+            # Show new Amazon columns
+            new_amazon_columns = [col for col in amazon_columns if col in new_columns]
+            print(f"   Amazon columns: {new_amazon_columns}")
         
-        # Close connection
-        conn.close()
+            # Check total columns
+            print(f"   Total columns: {len(new_columns)}")
         
         print("\n🎉 Migration successful!")
         print("\nNext steps:")
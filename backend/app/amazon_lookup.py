@@ -4,177 +4,417 @@ Searches Amazon for washing machines and returns product data for affiliate link
 """
 
 import asyncio
-import aiohttp
+import httpx
 import re
+from selectolax.parser import HTMLParser
+from rapidfuzz import fuzz
+from rapidfuzz.utils import default_process
 import logging
-from typing import Optional, Dict, Any, List
-from urllib.parse import quote_plus, urlparse, parse_qs
+from typing import Optional, Dict, Any, List, Tuple
+from urllib.parse import urlparse, parse_qs
 import time
 import random
+from datetime import datetime, timedelta
 
 logger = logging.getLogger(__name__)
 
+USER_AGENTS = [
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
+    "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+]
+
+DEFAULT_HEADERS = {
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    "Accept-Language": "fr-FR,fr;q=0.9,en;q=0.8",
+    "DNT": "1",
+    "Upgrade-Insecure-Requests": "1",
+}
+
+# Patterns are compiled once at import; extraction runs on every search page
+# Pattern: /dp/XXXXXXXXXX or /gp/product/XXXXXXXXXX, in a single scan
+_ASIN_URL_RE = re.compile(r'/(?:dp|gp/product|product)/([A-Z0-9]{10})')
+_ASIN_RE = re.compile(r'[A-Z0-9]{10}')
+_ASIN_HTML_RE = re.compile(r'data-asin="([A-Z0-9]{10})"')
+# Byte-level twin used to find the first card in the raw response body without decoding it
+_ASIN_HTML_BYTES_RE = re.compile(rb'data-asin="([A-Z0-9]{10})"')
+_TITLE_RE = re.compile(r'<span[^>]*class="[^"]*a-text-normal[^"]*"[^>]*>([^<]+)</span>')
+_IMG_RE = re.compile(r'<img[^>]*src="([^"]*)"[^>]*data-image-latency="[^"]*"')
+_PRICE_RE = re.compile(r'<span[^>]*class="[^"]*a-price-whole[^"]*"[^>]*>([^<]+)</span>')
+
+# A search result card fits well within this many bytes after its data-asin
+CARD_WINDOW_BYTES = 20000
+
+# Result cards considered when picking the best title match for a search
+MAX_CANDIDATES = 5
+
+# Max simultaneous connections to amazon.fr from the shared client; over HTTP/2
+# concurrent searches are multiplexed as streams on a single connection
+MAX_CONNECTIONS_PER_HOST = 3
+# Amazon's robot-check page names its support address near the top of the document
+CAPTCHA_MARKER = b"api-services-support@amazon"
+CAPTCHA_PROBE_BYTES = 8192
+
+# Process-wide HTTP/2 client, lazily created so every lookup reuses warm connections
+_session: Optional[httpx.AsyncClient] = None
+
+
+async def get_session() -> httpx.AsyncClient:
+    """Return the shared HTTP/2 client, creating it on first use"""
+    global _session
+    if _session is None or _session.is_closed:
+        # Accept-Encoding is left to httpx so only decodable encodings are advertised
+        _session = httpx.AsyncClient(
+            http2=True,
+            headers=DEFAULT_HEADERS,
+            limits=httpx.Limits(
+                max_connections=MAX_CONNECTIONS_PER_HOST,
+                max_keepalive_connections=MAX_CONNECTIONS_PER_HOST,
+                keepalive_expiry=75,
+            ),
+            timeout=httpx.Timeout(30.0),
+            follow_redirects=True,
+        )
+    return _session
+
+
+async def close_session() -> None:
+    """Close the shared client (call once at shutdown)"""
+    global _session
+    if _session is not None and not _session.is_closed:
+        await _session.aclose()
+    _session = None
+
+
+class HostRateLimiter:
+    """Leaky-bucket limiter spacing requests to a host at max_rate per time_period"""
+
+    def __init__(self, max_rate: float, time_period: float):
+        self.interval = time_period / max_rate
+        self._next_slot = 0.0
+
+    async def __aenter__(self):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        # Reserve the next free slot synchronously so concurrent callers queue up in order
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+# Politeness budget for amazon.fr: one search every 2 seconds
+AMAZON_MAX_RATE = 1
+AMAZON_TIME_PERIOD = 2.0
+
+
+class AmazonLookupCache:
+    """Persistent (brand, model) -> product cache stored in DuckDB
+    
+    Misses ("no product found") are cached too, so incremental runs do not
+    search the same unmatched models again until the entry expires.
+    """
+    
+    def __init__(self, conn, ttl_days: int = 30):
+        self.conn = conn
+        self.ttl = timedelta(days=ttl_days)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS amazon_lookup_cache (
+                key VARCHAR PRIMARY KEY,
+                asin VARCHAR,
+                title VARCHAR,
+                image_url VARCHAR,
+                price_eur DECIMAL(10,2),
+                product_url VARCHAR,
+                fetched_at TIMESTAMP
+            )
+        """)
+    
+    @staticmethod
+    def _key(brand: str, model: str) -> str:
+        return " ".join(f"{brand} {model}".lower().split())
+    
+    def get(self, brand: str, model: str) -> Tuple[bool, Optional[Dict[str, Any]]]:
+        """Return (hit, product); product is None for a cached miss"""
+        try:
+            row = self.conn.execute(
+                """
+                SELECT asin, title, image_url, price_eur, product_url
+                FROM amazon_lookup_cache
+                WHERE key = ? AND fetched_at > ?
+                """,
+                [self._key(brand, model), datetime.now() - self.ttl]
+            ).fetchone()
+        except Exception as e:
+            logger.warning(f"Amazon lookup cache read failed: {e}")
+            return False, None
+        if row is None:
+            return False, None
+        asin, title, image_url, price_eur, product_url = row
+        if asin is None:
+            return True, None
+        return True, {
+            "asin": asin,
+            "title": title,
+            "image_url": image_url,
+            "price_eur": float(price_eur) if price_eur is not None else None,
+            "product_url": product_url
+        }
+    
+    def put(self, brand: str, model: str, product: Optional[Dict[str, Any]]) -> None:
+        product = product or {}
+        try:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO amazon_lookup_cache VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    self._key(brand, model),
+                    product.get("asin"),
+                    product.get("title"),
+                    product.get("image_url"),
+                    product.get("price_eur"),
+                    product.get("product_url"),
+                    datetime.now(),
+                ]
+            )
+        except Exception as e:
+            logger.warning(f"Amazon lookup cache write failed: {e}")
+
+
 class AmazonProductLookup:
     """Service to find Amazon products for washing machines"""
     
-    def __init__(self, affiliate_tag: str = "lebrugere-21"):
+    # Shared by all instances so the budget applies to the host, not the lookup
+    _limiter = HostRateLimiter(AMAZON_MAX_RATE, AMAZON_TIME_PERIOD)
+    
+    def __init__(self, affiliate_tag: str = "lebrugere-21", cache: Optional[AmazonLookupCache] = None):
         self.affiliate_tag = affiliate_tag
+        self.cache = cache
         self.base_url = "https://www.amazon.fr"
+        # Parsed once; query parameters are encoded by httpx per request
+        self._search_base = httpx.URL(f"{self.base_url}/s")
         self.session = None
-        self.user_agents = [
-            "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
-            "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
-            "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-        ]
+        self.user_agents = USER_AGENTS
         
     async def __aenter__(self):
-        self.session = aiohttp.ClientSession(
-            headers={
-                "User-Agent": random.choice(self.user_agents),
-                "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-                "Accept-Language": "fr-FR,fr;q=0.9,en;q=0.8",
-                "Accept-Encoding": "gzip, deflate, br",
-                "DNT": "1",
-                "Connection": "keep-alive",
-                "Upgrade-Insecure-Requests": "1",
-            }
-        )
+        self.session = await get_session()
         return self
         
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        if self.session:
-            await self.session.close()
+        # The session is shared across lookups; it is closed by close_session()
+        self.session = None
     
-    def _build_search_url(self, brand: str, model: str) -> str:
-        """Build Amazon search URL for brand + model"""
+    def _build_search_url(self, brand: str, model: str) -> Tuple[httpx.URL, Dict[str, str]]:
+        """Build Amazon search URL and query parameters for brand + model"""
         search_query = f"{brand} {model}".strip()
-        encoded_query = quote_plus(search_query)
-        return f"{self.base_url}/s?k={encoded_query}&tag={self.affiliate_tag}"
+        return self._search_base, {"k": search_query, "tag": self.affiliate_tag}
     
     def _extract_asin_from_url(self, url: str) -> Optional[str]:
         """Extract ASIN from Amazon product URL"""
-        # Pattern: /dp/XXXXXXXXXX or /gp/product/XXXXXXXXXX
-        asin_patterns = [
-            r'/dp/([A-Z0-9]{10})',
-            r'/gp/product/([A-Z0-9]{10})',
-            r'/product/([A-Z0-9]{10})'
-        ]
-        
-        for pattern in asin_patterns:
-            match = re.search(pattern, url)
-            if match:
-                return match.group(1)
-        return None
-    
-    def _extract_product_data(self, html: str) -> Optional[Dict[str, Any]]:
-        """Extract product data from Amazon search results HTML"""
-        try:
-            # Look for the first product result
-            # This is a simplified parser - in production you might want to use a more robust solution
-            
-            # Extract ASIN from data attributes
-            asin_match = re.search(r'data-asin="([A-Z0-9]{10})"', html)
-            if not asin_match:
-                return None
-                
-            asin = asin_match.group(1)
-            
-            # Extract product title
-            title_match = re.search(r'<span[^>]*class="[^"]*a-text-normal[^"]*"[^>]*>([^<]+)</span>', html)
-            title = title_match.group(1).strip() if title_match else None
-            
-            # Extract image URL
-            img_match = re.search(r'<img[^>]*src="([^"]*)"[^>]*data-image-latency="[^"]*"', html)
-            img_url = img_match.group(1) if img_match else None
-            
-            # Extract price (simplified)
-            price_match = re.search(r'<span[^>]*class="[^"]*a-price-whole[^"]*"[^>]*>([^<]+)</span>', html)
-            price_text = price_match.group(1).replace('\xa0', '').replace(',', '.') if price_match else None
-            price = float(price_text) if price_text and price_text.replace('.', '').isdigit() else None
+        match = _ASIN_URL_RE.search(url)
+        return match.group(1) if match else None
+    
+    def _parse_result_card(self, html: str) -> Optional[Dict[str, Any]]:
+        """Read the first search result card in a single DOM pass"""
+        tree = HTMLParser(html)
+        card = tree.css_first('div[data-asin]:not([data-asin=""])')
+        if card is None:
+            return None
+        
+        asin = card.attributes.get('data-asin')
+        if not asin or not _ASIN_RE.fullmatch(asin):
+            return None
+        
+        title_node = card.css_first('span.a-text-normal')
+        img_node = card.css_first('img.s-image')
+        # Direct text only: the decimal separator lives in a nested span
+        price_node = card.css_first('span.a-price-whole')
+        
+        return {
+            "asin": asin,
+            "title": title_node.text().strip() if title_node else None,
+            "image_url": img_node.attributes.get('src') if img_node else None,
+            "price_text": price_node.text(deep=False) if price_node else None,
+        }
+    
+    def _regex_result_card(self, html: str) -> Optional[Dict[str, Any]]:
+        """Fallback scan of the raw HTML when the card selectors miss"""
+        asin_match = _ASIN_HTML_RE.search(html)
+        if not asin_match:
+            return None
+        
+        title_match = _TITLE_RE.search(html)
+        img_match = _IMG_RE.search(html)
+        price_match = _PRICE_RE.search(html)
+        
+        return {
+            "asin": asin_match.group(1),
+            "title": title_match.group(1).strip() if title_match else None,
+            "image_url": img_match.group(1) if img_match else None,
+            "price_text": price_match.group(1) if price_match else None,
+        }
+    
+    def _build_product(self, card: Dict[str, Any]) -> Dict[str, Any]:
+        """Turn a parsed result card into the product dict returned to callers"""
+        asin = card["asin"]
+        
+        # Extract price (simplified)
+        price_text = card["price_text"]
+        if price_text:
+            price_text = price_text.replace('\xa0', '').replace(',', '.').strip()
+        price = float(price_text) if price_text and price_text.replace('.', '').isdigit() else None
+        
+        # Build direct product URL with affiliate tag
+        product_url = f"{self.base_url}/dp/{asin}?tag={self.affiliate_tag}"
+        
+        return {
+            "asin": asin,
+            "title": card["title"],
+            "image_url": card["image_url"],
+            "price_eur": price,
+            "product_url": product_url
+        }
+    
+    def _extract_candidates(self, raw: bytes, k: int = MAX_CANDIDATES) -> List[Dict[str, Any]]:
+        """Extract up to k result cards from the raw search page in a single pass"""
+        candidates: List[Dict[str, Any]] = []
+        seen = set()
+        for asin_match in _ASIN_HTML_BYTES_RE.finditer(raw):
+            asin = asin_match.group(1).decode('ascii')
+            # Cards repeat their ASIN on nested elements
+            if asin in seen:
+                continue
+            seen.add(asin)
             
-            # Build direct product URL with affiliate tag
-            product_url = f"{self.base_url}/dp/{asin}?tag={self.affiliate_tag}"
+            # Only decode/parse a window starting at the card's opening tag
+            start = max(raw.rfind(b'<', 0, asin_match.start()), 0)
+            window = raw[start:asin_match.end() + CARD_WINDOW_BYTES].decode('utf-8', 'replace')
             
-            return {
-                "asin": asin,
-                "title": title,
-                "image_url": img_url,
-                "price_eur": price,
-                "product_url": product_url
-            }
+            card = self._parse_result_card(window)
+            if card is None:
+                card = self._regex_result_card(window)
+                if card is None:
+                    continue
+                # Surface selector drift: the page had a result the CSS selectors did not find
+                logger.warning(f"Result card selectors missed, used regex fallback for {card['asin']}")
             
-        except Exception as e:
-            logger.error(f"Error extracting product data: {e}")
+            candidates.append(self._build_product(card))
+            if len(candidates) >= k:
+                break
+        if seen and not candidates:
+            # Result cards were there but none could be read: the markup changed
+            raise ValueError(f"None of {len(seen)} result cards could be parsed")
+        return candidates
+    
+    def _extract_product_data(self, raw: bytes, query: str = "") -> Optional[Dict[str, Any]]:
+        """Extract the result best matching query from the raw Amazon search results HTML
+
+        Returns None when the page has no result cards; raises when it has cards
+        that can't be parsed, so callers don't mistake a parse failure for a miss.
+        """
+        candidates = self._extract_candidates(raw)
+        if not candidates:
             return None
+        if not query or len(candidates) == 1:
+            return candidates[0]
+        # Highest title similarity wins; ties keep Amazon's ranking
+        return max(
+            candidates,
+            key=lambda c: fuzz.token_set_ratio(query, c["title"] or "", processor=default_process),
+        )
     
     async def search_product(self, brand: str, model: str) -> Optional[Dict[str, Any]]:
-        """Search Amazon for a specific washing machine and return product data"""
-        try:
-            search_url = self._build_search_url(brand, model)
-            logger.info(f"Searching Amazon for: {brand} {model}")
-            
-            # Add random delay to be respectful
-            await asyncio.sleep(random.uniform(1, 3))
-            
-            async with self.session.get(search_url) as response:
-                if response.status != 200:
-                    logger.warning(f"Amazon search failed with status {response.status}")
-                    return None
-                    
-                html = await response.text()
-                
-                # Check if we got a valid HTML response
-                if "amazon" not in html.lower() or len(html) < 1000:
-                    logger.warning("Invalid response from Amazon")
-                    return None
-                
-                product_data = self._extract_product_data(html)
-                if product_data:
-                    logger.info(f"Found product: {product_data['asin']} - {product_data['title']}")
-                    return product_data
-                else:
-                    logger.info(f"No product found for: {brand} {model}")
-                    return None
-                    
-        except Exception as e:
-            logger.error(f"Error searching Amazon for {brand} {model}: {e}")
+        """Search Amazon for a specific washing machine and return product data
+
+        Returns None when Amazon has no match or turns the request away (status,
+        CAPTCHA); transport and parse errors are raised to the caller.
+        """
+        if self.cache is not None:
+            hit, cached = self.cache.get(brand, model)
+            if hit:
+                logger.info(f"Amazon cache hit for: {brand} {model}")
+                return cached
+        
+        search_url, params = self._build_search_url(brand, model)
+        logger.info(f"Searching Amazon for: {brand} {model}")
+        
+        session = self.session or await get_session()
+        headers = {"User-Agent": random.choice(self.user_agents)}
+        
+        # Wait for a slot in the host-wide budget, with a little jitter to avoid bursts
+        async with self._limiter:
+            await asyncio.sleep(random.uniform(0, 0.3))
+            response = await session.get(search_url, params=params, headers=headers)
+        logger.debug(f"Amazon responded over {response.http_version}")
+        if response.status_code != 200:
+            logger.warning(f"Amazon search failed with status {response.status_code}")
+            return None
+        
+        # Keep the body as bytes: only the first card is ever decoded
+        raw = response.content
+        
+        # Cheap byte probes instead of lowercasing the whole page; rejects are not cached
+        if len(raw) < 1000:
+            logger.warning(f"Invalid response from Amazon: body too short ({len(raw)} bytes)")
+            return None
+        if CAPTCHA_MARKER in raw[:CAPTCHA_PROBE_BYTES]:
+            logger.warning(f"Amazon returned a CAPTCHA page for: {brand} {model}")
+            return None
+        if b"data-asin" not in raw:
+            logger.warning(f"Amazon returned a page without results for: {brand} {model}")
+            return None
+        
+        # Raises on a page we couldn't parse, so only real results and misses are cached;
+        # failed requests are retried next run
+        product_data = self._extract_product_data(raw, f"{brand} {model}")
+        if self.cache is not None:
+            self.cache.put(brand, model, product_data)
+        if product_data:
+            logger.info(f"Found product: {product_data['asin']} - {product_data['title']}")
+            return product_data
+        else:
+            logger.info(f"No product found for: {brand} {model}")
             return None
     
-    async def batch_search_products(self, machines: List[Dict[str, Any]], 
-                                   max_concurrent: int = 3) -> List[Dict[str, Any]]:
-        """Search multiple machines concurrently"""
-        semaphore = asyncio.Semaphore(max_concurrent)
-        
-        async def search_with_semaphore(machine):
-            async with semaphore:
-                brand = machine.get('nom_metteur_sur_le_marche', '')
-                model = machine.get('nom_modele', machine.get('id_unique', ''))
-                
-                if not brand or not model:
-                    return machine
-                
-                product_data = await self.search_product(brand, model)
-                if product_data:
-                    machine.update({
-                        'amazon_asin': product_data['asin'],
-                        'amazon_product_url': product_data['product_url'],
-                        'amazon_image_url': product_data['image_url'],
-                        'amazon_price_eur': product_data['price_eur'],
-                        'amazon_product_title': product_data['title'],
-                        'amazon_last_checked': time.time()
-                    })
-                
-                return machine
+    async def batch_search_products(self, machines: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[Exception]]:
+        """Search multiple machines concurrently (paced by the host rate limiter)
+        
+        Machines are enriched in place; returns the input list and the errors raised.
+        """
         
-        tasks = [search_with_semaphore(machine) for machine in machines]
-        results = await asyncio.gather(*tasks, return_exceptions=True)
+        async def search_one(machine):
+            brand = machine.get('nom_metteur_sur_le_marche', '')
+            model = machine.get('nom_modele', machine.get('id_unique', ''))
+            
+            if not brand or not model:
+                return machine
+            
+            try:
+                product_data = await self.search_product(brand, model)
+            except Exception as e:
+                logger.error(f"Error searching Amazon for {brand} {model}: {e}")
+                raise
+            if product_data:
+                machine.update({
+                    'amazon_asin': product_data['asin'],
+                    'amazon_product_url': product_data['product_url'],
+                    'amazon_image_url': product_data['image_url'],
+                    'amazon_price_eur': product_data['price_eur'],
+                    'amazon_product_title': product_data['title'],
+                    'amazon_last_checked': time.time()
+                })
+            
+            return machine
         
-        # Filter out exceptions
-        valid_results = []
-        for result in results:
-            if isinstance(result, Exception):
-                logger.error(f"Search failed: {result}")
-            else:
-                valid_results.append(result)
+        # Failures are logged by search_one as they happen, not after the whole batch drains
+        errors: List[Exception] = []
+        for task in asyncio.as_completed([search_one(machine) for machine in machines]):
+            try:
+                await task
+            except Exception as e:
+                errors.append(e)
         
-        return valid_results
+        return machines, errors
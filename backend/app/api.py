@@ -1,11 +1,25 @@
-from fastapi import APIRouter, HTTPException, Query
-from typing import List, Optional
-import json
+from fastapi import APIRouter, Header, HTTPException, Query, Response
+from fastapi.responses import StreamingResponse
+from collections import defaultdict
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Set
+import gzip
+import hashlib
 import logging
+import re
+
+import brotli
+import numpy as np
+import orjson
+import pandas as pd
+from cachetools.func import ttl_cache
+from pandas.api.types import is_bool_dtype, is_numeric_dtype, is_object_dtype
 
 logger = logging.getLogger(__name__)
 
-# No need to import ingest functions for basic API functionality
+# No need to import ingest functions for basic API functionality;
+# the data.gouv.fr helpers are imported lazily by the endpoints that need them
 
 # Import search functionality
 from .search import (
@@ -14,265 +28,262 @@ from .search import (
     get_brands,
     get_statistics
 )
+from .duckdb_utils import on_database_reload
+from .json_utils import dumps, json_response
 
 router = APIRouter()
 
-# Example static data matching frontend expectations
-MACHINES = [
-    {
-        "id": 1,
-        "brand": "Acme",
-        "model_name": "Model X",
-        "current_score": 8.5,
-    },
-    {
-        "id": 2,
-        "brand": "Beta",
-        "model_name": "Model Y",
-        "current_score": 7.2,
-    },
-]
-
-# Mock data for fallback when database is not available
-MOCK_MACHINES = [
-    {
-        "id": 1,
-        "id_unique": "SAMSUNG-WF20DG8650BVU3",
-        "nom_modele": "SAMSUNG WF20DG8650BVU3 Hublot",
-        "nom_metteur_sur_le_marche": "SAMSUNG",
-        "date_calcul": "2025-03-26",
-        "note_reparabilite": 9.9,
-        "note_fiabilite": 6.9,
-        "note_id": 8.4,
-        "categorie_produit": "Lave-linge",
-        "url_tableau_detail_notation": "https://example.com/report1",
-        "accessibilite_compteur_usage": "Accessible",
-        "lien_documentation_professionnels": "https://example.com/pro-doc",
-        "lien_documentation_particuliers": "https://example.com/user-doc",
-        "note_A_c1": 9.5, "note_A_c2": 9.8, "note_A_c3": 9.2, "note_A_c4": 9.7,
-        "note_B_c1": 6.5, "note_B_c2": 7.2, "note_B_c3": 7.0,
-        "nom_piece_1_liste_2": "Moteur de lavage", "nom_piece_2_liste_2": "Pompe de vidange",
-        "nom_piece_3_liste_2": "Électrovanne d'alimentation", "nom_piece_4_liste_2": "Capteur de niveau d'eau",
-        "nom_piece_5_liste_2": "Carte électronique principale",
-        "etape_demontage_piece_1_liste_2": "Débrancher l'alimentation, retirer le panneau arrière, déconnecter les câbles",
-        "etape_demontage_piece_2_liste_2": "Vider l'eau, retirer le tuyau de vidange, dévisser la pompe",
-        "etape_demontage_piece_3_liste_2": "Fermer l'alimentation d'eau, déconnecter les tuyaux, retirer l'électrovanne",
-        "etape_demontage_piece_4_liste_2": "Retirer le panneau de commande, localiser le capteur, le déconnecter",
-        "etape_demontage_piece_5_liste_2": "Débrancher tous les connecteurs, retirer les vis de fixation"
-    },
-    {
-        "id": 2,
-        "id_unique": "LG-FHT1408ZWL",
-        "nom_modele": "LG FHT1408ZWL Hublot",
-        "nom_metteur_sur_le_marche": "LG",
-        "date_calcul": "2025-03-25",
-        "note_reparabilite": 8.7,
-        "note_fiabilite": 7.5,
-        "note_id": 8.1,
-        "categorie_produit": "Lave-linge",
-        "url_tableau_detail_notation": "https://example.com/report2",
-        "accessibilite_compteur_usage": "Accessible",
-        "lien_documentation_professionnels": "https://example.com/lg-pro-doc",
-        "lien_documentation_particuliers": "https://example.com/lg-user-doc",
-        "note_A_c1": 8.5, "note_A_c2": 8.8, "note_A_c3": 8.2, "note_A_c4": 8.9,
-        "note_B_c1": 7.0, "note_B_c2": 7.8, "note_B_c3": 7.5,
-        "nom_piece_1_liste_2": "Moteur de lavage LG", "nom_piece_2_liste_2": "Pompe de vidange LG",
-        "nom_piece_3_liste_2": "Électrovanne d'alimentation LG", "nom_piece_4_liste_2": "Capteur de niveau d'eau LG",
-        "nom_piece_5_liste_2": "Carte électronique principale LG",
-        "etape_demontage_piece_1_liste_2": "Retirer le panneau latéral, déconnecter les câbles du moteur",
-        "etape_demontage_piece_2_liste_2": "Vider l'eau, retirer le tuyau, dévisser la pompe LG",
-        "etape_demontage_piece_3_liste_2": "Fermer l'eau, déconnecter les tuyaux, retirer l'électrovanne LG",
-        "etape_demontage_piece_4_liste_2": "Retirer le panneau, localiser le capteur LG",
-        "etape_demontage_piece_5_liste_2": "Débrancher tous les connecteurs, retirer les vis LG"
-    },
-    {
-        "id": 3,
-        "id_unique": "BOSCH-WAT28400FF",
-        "nom_modele": "BOSCH WAT28400FF Hublot",
-        "nom_metteur_sur_le_marche": "BOSCH",
-        "date_calcul": "2025-03-24",
-        "note_reparabilite": 9.2,
-        "note_fiabilite": 8.8,
-        "note_id": 9.0,
-        "categorie_produit": "Lave-linge",
-        "url_tableau_detail_notation": "https://example.com/report3",
-        "accessibilite_compteur_usage": "Accessible",
-        "lien_documentation_professionnels": "https://example.com/bosch-pro-doc",
-        "lien_documentation_particuliers": "https://example.com/bosch-user-doc",
-        "note_A_c1": 9.0, "note_A_c2": 9.5, "note_A_c3": 8.8, "note_A_c4": 9.3,
-        "note_B_c1": 8.5, "note_B_c2": 9.0, "note_B_c3": 8.9,
-        "nom_piece_1_liste_2": "Moteur de lavage Bosch", "nom_piece_2_liste_2": "Pompe de vidange Bosch",
-        "nom_piece_3_liste_2": "Électrovanne d'alimentation Bosch", "nom_piece_4_liste_2": "Capteur de niveau d'eau Bosch",
-        "nom_piece_5_liste_2": "Carte électronique principale Bosch",
-        "etape_demontage_piece_1_liste_2": "Retirer le panneau, déconnecter les câbles Bosch",
-        "etape_demontage_piece_2_liste_2": "Vider l'eau, retirer le tuyau Bosch",
-        "etape_demontage_piece_3_liste_2": "Fermer l'eau, déconnecter les tuyaux Bosch",
-        "etape_demontage_piece_4_liste_2": "Retirer le panneau, localiser le capteur Bosch",
-        "etape_demontage_piece_5_liste_2": "Débrancher tous les connecteurs Bosch"
-    },
-    {
-        "id": 4,
-        "id_unique": "WHIRLPOOL-FSCR12440",
-        "nom_modele": "WHIRLPOOL FSCR12440 Top",
-        "nom_metteur_sur_le_marche": "WHIRLPOOL",
-        "date_calcul": "2025-03-23",
-        "note_reparabilite": 7.8,
-        "note_fiabilite": 8.2,
-        "note_id": 8.0,
-        "categorie_produit": "Lave-linge",
-        "url_tableau_detail_notation": "https://example.com/report4",
-        "accessibilite_compteur_usage": "Accessible",
-        "lien_documentation_professionnels": "https://example.com/whirlpool-pro-doc",
-        "lien_documentation_particuliers": "https://example.com/whirlpool-user-doc",
-        "note_A_c1": 7.5, "note_A_c2": 8.0, "note_A_c3": 7.8, "note_A_c4": 8.2,
-        "note_B_c1": 8.0, "note_B_c2": 8.5, "note_B_c3": 8.1,
-        "nom_piece_1_liste_2": "Moteur de lavage Whirlpool", "nom_piece_2_liste_2": "Pompe de vidange Whirlpool",
-        "nom_piece_3_liste_2": "Électrovanne d'alimentation Whirlpool", "nom_piece_4_liste_2": "Capteur de niveau d'eau Whirlpool",
-        "nom_piece_5_liste_2": "Carte électronique principale Whirlpool",
-        "etape_demontage_piece_1_liste_2": "Retirer le panneau, déconnecter les câbles Whirlpool",
-        "etape_demontage_piece_2_liste_2": "Vider l'eau, retirer le tuyau Whirlpool",
-        "etape_demontage_piece_3_liste_2": "Fermer l'eau, déconnecter les tuyaux Whirlpool",
-        "etape_demontage_piece_4_liste_2": "Retirer le panneau, localiser le capteur Whirlpool",
-        "etape_demontage_piece_5_liste_2": "Débrancher tous les connecteurs Whirlpool"
-    },
-    {
-        "id": 5,
-        "id_unique": "ELECTROLUX-EW6F1406I",
-        "nom_modele": "ELECTROLUX EW6F1406I Hublot",
-        "nom_metteur_sur_le_marche": "ELECTROLUX",
-        "date_calcul": "2025-03-22",
-        "note_reparabilite": 8.5,
-        "note_fiabilite": 7.8,
-        "note_id": 8.2,
-        "categorie_produit": "Lave-linge",
-        "url_tableau_detail_notation": "https://example.com/report5",
-        "accessibilite_compteur_usage": "Accessible",
-        "lien_documentation_professionnels": "https://example.com/electrolux-pro-doc",
-        "lien_documentation_particuliers": "https://example.com/electrolux-user-doc",
-        "note_A_c1": 8.2, "note_A_c2": 8.7, "note_A_c3": 8.0, "note_A_c4": 8.8,
-        "note_B_c1": 7.5, "note_B_c2": 8.0, "note_B_c3": 7.9,
-        "nom_piece_1_liste_2": "Moteur de lavage Electrolux", "nom_piece_2_liste_2": "Pompe de vidange Electrolux",
-        "nom_piece_3_liste_2": "Électrovanne d'alimentation Electrolux", "nom_piece_4_liste_2": "Capteur de niveau d'eau Electrolux",
-        "nom_piece_5_liste_2": "Carte électronique principale Electrolux",
-        "etape_demontage_piece_1_liste_2": "Retirer le panneau, déconnecter les câbles Electrolux",
-        "etape_demontage_piece_2_liste_2": "Vider l'eau, retirer le tuyau Electrolux",
-        "etape_demontage_piece_3_liste_2": "Fermer l'eau, déconnecter les tuyaux Electrolux",
-        "etape_demontage_piece_4_liste_2": "Retirer le panneau, localiser le capteur Electrolux",
-        "etape_demontage_piece_5_liste_2": "Débrancher tous les connecteurs Electrolux"
-    },
-    {
-        "id": 6,
-        "id_unique": "CANDY-CS1412D3",
-        "nom_modele": "CANDY CS1412D3 Hublot",
-        "nom_metteur_sur_le_marche": "CANDY",
-        "date_calcul": "2025-03-21",
-        "note_reparabilite": 6.5,
-        "note_fiabilite": 6.8,
-        "note_id": 6.7,
-        "categorie_produit": "Lave-linge",
-        "url_tableau_detail_notation": "https://example.com/report6",
-        "accessibilite_compteur_usage": "Accessible",
-        "lien_documentation_professionnels": "https://example.com/candy-pro-doc",
-        "lien_documentation_particuliers": "https://example.com/candy-user-doc",
-        "note_A_c1": 6.0, "note_A_c2": 6.8, "note_A_c3": 6.2, "note_A_c4": 6.9,
-        "note_B_c1": 6.5, "note_B_c2": 7.0, "note_B_c3": 6.9,
-        "nom_piece_1_liste_2": "Moteur de lavage Candy", "nom_piece_2_liste_2": "Pompe de vidange Candy",
-        "nom_piece_3_liste_2": "Électrovanne d'alimentation Candy", "nom_piece_4_liste_2": "Capteur de niveau d'eau Candy",
-        "nom_piece_5_liste_2": "Carte électronique principale Candy",
-        "etape_demontage_piece_1_liste_2": "Retirer le panneau, déconnecter les câbles Candy",
-        "etape_demontage_piece_2_liste_2": "Vider l'eau, retirer le tuyau Candy",
-        "etape_demontage_piece_3_liste_2": "Fermer l'eau, déconnecter les tuyaux Candy",
-        "etape_demontage_piece_4_liste_2": "Retirer le panneau, localiser le capteur Candy",
-        "etape_demontage_piece_5_liste_2": "Débrancher tous les connecteurs Candy"
-    }
-]
+
+def _datasets_summary() -> dict:
+    from ingest.fetch_wmdi import get_washing_machine_datasets_summary
+    return get_washing_machine_datasets_summary()
+
+
+# Endpoints whose payload only changes on ingestion
+_CACHED_PAYLOADS = {
+    "datasets": _datasets_summary,
+    "brands": lambda: {"brands": get_brands()},
+    "statistics": get_statistics,
+}
+
+
+class _CachedPayload(NamedTuple):
+    etag: str
+    # Body per content coding, compressed once per cache fill instead of per request
+    bodies: Dict[str, bytes]
+
+
+@ttl_cache(maxsize=32, ttl=300)
+def _cached_payload(name: str) -> _CachedPayload:
+    """Serialized response bodies and their ETag, rebuilt at most every 5 minutes; failures are not cached"""
+    body = dumps(_CACHED_PAYLOADS[name]())
+    return _CachedPayload(
+        etag=f'W/"{hashlib.blake2b(body, digest_size=8).hexdigest()}"',
+        bodies={
+            "identity": body,
+            "br": brotli.compress(body, quality=4),
+            "gzip": gzip.compress(body, compresslevel=6),
+        },
+    )
+
+
+on_database_reload(_cached_payload.cache_clear)
+
+
+def _pick_encoding(accept_encoding: Optional[str]) -> str:
+    if not accept_encoding:
+        return "identity"
+    accepted = set()
+    for token in accept_encoding.lower().replace(" ", "").split(","):
+        coding, _, params = token.partition(";")
+        # "q=0" (or "q=0.0", ...) explicitly refuses the coding
+        if params.rstrip("0.") != "q=":
+            accepted.add(coding)
+    for encoding in ("br", "gzip"):
+        if encoding in accepted:
+            return encoding
+    return "identity"
+
+
+def _cached_response(name: str, if_none_match: Optional[str] = None,
+                     accept_encoding: Optional[str] = None) -> Response:
+    payload = _cached_payload(name)
+    headers = {"ETag": payload.etag, "Vary": "Accept-Encoding"}
+    if if_none_match and (if_none_match.strip() == "*" or payload.etag in (t.strip() for t in if_none_match.split(","))):
+        return Response(status_code=304, headers=headers)
+    encoding = _pick_encoding(accept_encoding)
+    if encoding != "identity":
+        # GZipMiddleware passes responses that already carry a Content-Encoding through untouched
+        headers["Content-Encoding"] = encoding
+    return Response(content=payload.bodies[encoding], media_type="application/json", headers=headers)
+
+
+def _load_dataset_frame(dataset_id: str):
+    from ingest.fetch_wmdi import load_washing_machine_data
+    return load_washing_machine_data(dataset_id)
+
+
+# Sample rows encoded per chunk, so the full sample never exists as one JSON string
+SAMPLE_CHUNK_ROWS = 500
+
+
+def _stream_dataset_summary(summary: bytes, sample: pd.DataFrame):
+    """Yield the summary object with a "sample_data" array appended chunk by chunk"""
+    yield summary[:-1] + b',"sample_data":['
+    for start in range(0, len(sample), SAMPLE_CHUNK_ROWS):
+        # pandas' C writer encodes the rows; strip the enclosing brackets to splice chunks
+        rows = sample.iloc[start:start + SAMPLE_CHUNK_ROWS].to_json(orient="records", date_format="iso")
+        yield (b"," if start else b"") + rows[1:-1].encode()
+    yield b"]}"
+
+# Query-intent keywords, checked in order against the lowercased query; first match wins
+_INTENT_PATTERNS = {
+    "repairability": re.compile(r"réparable|repairability|plus reparable"),
+    "reliability": re.compile(r"fiable|reliability|plus reliable"),
+    "durability": re.compile(r"durable|durability"),
+    "excellent": re.compile(r"excellent|meilleur"),
+    "budget": re.compile(r"bon marché|économique"),
+    "loading": re.compile(r"hublot|top|front|charge"),
+}
+
+# Filter/sort overrides the database search applies for each intent (the text query is dropped)
+_INTENT_OVERRIDES = {
+    "repairability": {"min_repairability": 7.0, "sort_by": "note_reparabilite"},
+    "reliability": {"min_reliability": 6.0, "sort_by": "note_fiabilite"},
+    "durability": {"sort_by": "note_id"},
+    "excellent": {"min_repairability": 8.0, "min_reliability": 7.0, "sort_by": "note_id"},
+    "budget": {"max_repairability": 6.0, "max_reliability": 6.0, "sort_by": "note_id"},
+}
+
+
+def _classify_intent(query_lower: str) -> Optional[str]:
+    for intent, pattern in _INTENT_PATTERNS.items():
+        if pattern.search(query_lower):
+            return intent
+    return None
+
+
+# Mock data for fallback when database is not available; only loaded on first fallback
+_MOCK_MACHINES_PATH = Path(__file__).with_name("mock_machines.json")
+
+
+@lru_cache(maxsize=1)
+def _mock_machines() -> List[dict]:
+    return orjson.loads(_MOCK_MACHINES_PATH.read_bytes())
+
+
+class _MockColumns(NamedTuple):
+    """Column-wise view of the mock data: fallback filters become vectorized masks"""
+    df: pd.DataFrame
+    model_lc: pd.Series
+    brand_lc: pd.Series
+    rep: np.ndarray
+    fia: np.ndarray
+    note_id: np.ndarray
+    # Trigram -> row positions over "model brand", for narrowing free-text search
+    trigrams: Dict[str, Set[int]]
+
+
+def _trigrams(text: str) -> Set[str]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+@lru_cache(maxsize=1)
+def _mock_columns() -> _MockColumns:
+    df = pd.DataFrame(_mock_machines())
+    model_lc = df["nom_modele"].str.lower()
+    brand_lc = df["nom_metteur_sur_le_marche"].str.lower()
+    trigrams = defaultdict(set)
+    for row, text in enumerate(model_lc + " " + brand_lc):
+        for trigram in _trigrams(text):
+            trigrams[trigram].add(row)
+    return _MockColumns(
+        df=df,
+        model_lc=model_lc,
+        brand_lc=brand_lc,
+        rep=df["note_reparabilite"].to_numpy(),
+        fia=df["note_fiabilite"].to_numpy(),
+        note_id=df["note_id"].to_numpy(),
+        trigrams=dict(trigrams),
+    )
+
+
+def _trigram_mask(mock: _MockColumns, query_lower: str) -> Optional[np.ndarray]:
+    """Rows containing every trigram of the query (a superset of the substring matches);
+    None when the query is too short to have trigrams"""
+    query_trigrams = _trigrams(query_lower)
+    if not query_trigrams:
+        return None
+    mask = np.zeros(len(mock.df), dtype=bool)
+    rows = set.intersection(*(mock.trigrams.get(t, set()) for t in query_trigrams))
+    mask[list(rows)] = True
+    return mask
+
+
+_MOCK_SORT_FIELDS = {"note_reparabilite", "note_fiabilite", "note_id", "date_calcul"}
 
 def get_mock_search_results(q=None, brand=None, model=None, min_repairability=None, max_repairability=None,
                           min_reliability=None, max_reliability=None, year=None, limit=50, offset=0, 
                           sort_by="note_reparabilite", sort_order="DESC"):
     """Fallback function that provides mock search results when database is unavailable."""
-    filtered_machines = MOCK_MACHINES.copy()
+    mock = _mock_columns()
+    mask = np.ones(len(mock.df), dtype=bool)
+    # Deferred substring filters as (columns, needle, regex): a row passes if any column matches
+    text_filters = []
     
     # Apply filters
     if q:
         query_lower = q.lower()
+        intent = _classify_intent(query_lower)
         # Check if it's a special filter query
-        if any(keyword in query_lower for keyword in ["réparable", "repairability"]):
+        if intent == "repairability":
             # Filter by repairability
-            filtered_machines = [m for m in filtered_machines if m["note_reparabilite"] >= 7.0]
-            # Sort by repairability
-            filtered_machines.sort(key=lambda x: x["note_reparabilite"], reverse=True)
-        elif any(keyword in query_lower for keyword in ["fiable", "reliability"]):
+            mask &= mock.rep >= 7.0
+        elif intent == "reliability":
             # Filter by reliability
-            filtered_machines = [m for m in filtered_machines if m["note_fiabilite"] >= 6.0]
-            # Sort by reliability
-            filtered_machines.sort(key=lambda x: x["note_fiabilite"], reverse=True)
-        elif any(keyword in query_lower for keyword in ["durable", "durability"]):
+            mask &= mock.fia >= 6.0
+        elif intent == "durability":
             # Filter by overall durability (global score)
-            filtered_machines = [m for m in filtered_machines if m["note_id"] >= 7.0]
-            # Sort by global score
-            filtered_machines.sort(key=lambda x: x["note_id"], reverse=True)
-        elif any(keyword in query_lower for keyword in ["excellent", "meilleur"]):
+            mask &= mock.note_id >= 7.0
+        elif intent == "excellent":
             # Filter for excellent machines (high scores across all categories)
-            filtered_machines = [m for m in filtered_machines if m["note_reparabilite"] >= 8.0 and m["note_fiabilite"] >= 7.0]
-            # Sort by global score
-            filtered_machines.sort(key=lambda x: x["note_id"], reverse=True)
-        elif any(keyword in query_lower for keyword in ["bon marché", "économique"]):
+            mask &= (mock.rep >= 8.0) & (mock.fia >= 7.0)
+        elif intent == "budget":
             # Filter for affordable machines (lower scores but still decent)
-            filtered_machines = [m for m in filtered_machines if m["note_reparabilite"] <= 6.0 and m["note_fiabilite"] <= 6.0]
-            # Sort by global score
-            filtered_machines.sort(key=lambda x: x["note_id"], reverse=True)
-        elif any(keyword in query_lower for keyword in ["hublot", "top", "front", "charge"]):
+            mask &= (mock.rep <= 6.0) & (mock.fia <= 6.0)
+        elif intent == "loading":
             # Filter by loading type
-            filtered_machines = [
-                m for m in filtered_machines
-                if any(k in m["nom_modele"].lower() for k in ["hublot", "top", "front", "charge"])
-            ]
+            text_filters.append(((mock.model_lc,), _INTENT_PATTERNS["loading"].pattern, True))
         else:
-            # General text search
-            filtered_machines = [m for m in filtered_machines if 
-                               query_lower in m["nom_modele"].lower() or 
-                               query_lower in m["nom_metteur_sur_le_marche"].lower()]
+            # General text search: the trigram index narrows the rows, the substring check confirms
+            candidates = _trigram_mask(mock, query_lower)
+            if candidates is not None:
+                mask &= candidates
+            text_filters.append(((mock.model_lc, mock.brand_lc), query_lower, False))
     
     if brand:
-        filtered_machines = [m for m in filtered_machines if brand.lower() in m["nom_metteur_sur_le_marche"].lower()]
+        text_filters.append(((mock.brand_lc,), brand.lower(), False))
     
     if min_repairability is not None:
-        filtered_machines = [m for m in filtered_machines if m["note_reparabilite"] >= min_repairability]
+        mask &= mock.rep >= min_repairability
     
     if max_repairability is not None:
-        filtered_machines = [m for m in filtered_machines if m["note_reparabilite"] <= max_repairability]
+        mask &= mock.rep <= max_repairability
     
     if min_reliability is not None:
-        filtered_machines = [m for m in filtered_machines if m["note_fiabilite"] >= min_reliability]
+        mask &= mock.fia >= min_reliability
     
     if max_reliability is not None:
-        filtered_machines = [m for m in filtered_machines if m["note_fiabilite"] <= max_reliability]
+        mask &= mock.fia <= max_reliability
+    
+    # String matching is the costly part: only run it on rows the numeric masks kept
+    for columns, needle, regex in text_filters:
+        rows = np.flatnonzero(mask)
+        if not len(rows):
+            break
+        hit = np.zeros(len(rows), dtype=bool)
+        for col in columns:
+            hit |= col.iloc[rows].str.contains(needle, regex=regex).to_numpy()
+        mask[rows] = hit
     
     # Apply sorting
-    if sort_by == "note_reparabilite":
-        filtered_machines.sort(key=lambda x: x["note_reparabilite"], reverse=(sort_order == "DESC"))
-    elif sort_by == "note_fiabilite":
-        filtered_machines.sort(key=lambda x: x["note_fiabilite"], reverse=(sort_order == "DESC"))
-    elif sort_by == "note_id":
-        filtered_machines.sort(key=lambda x: x["note_id"], reverse=(sort_order == "DESC"))
-    elif sort_by == "date_calcul":
-        filtered_machines.sort(key=lambda x: x["date_calcul"], reverse=(sort_order == "DESC"))
+    if sort_by in _MOCK_SORT_FIELDS:
+        ascending = sort_order != "DESC"
     else:
         # Default sort by repairability
-        filtered_machines.sort(key=lambda x: x["note_reparabilite"], reverse=True)
+        sort_by, ascending = "note_reparabilite", False
+    filtered = mock.df[mask].sort_values(sort_by, ascending=ascending, kind="stable")
     
-    # Apply limit and offset
-    start_idx = offset
-    end_idx = start_idx + limit
-    limited_machines = filtered_machines[start_idx:end_idx]
+    # Apply limit and offset; only the returned page is turned back into dicts
+    end_idx = offset + limit
+    total = len(filtered)
     
     return {
-        "machines": limited_machines,
-        "total": len(filtered_machines),
+        "machines": filtered.iloc[offset:end_idx].to_dict(orient="records"),
+        "total": total,
         "limit": limit,
         "offset": offset,
-        "has_more": end_idx < len(filtered_machines)
+        "has_more": end_idx < total
     }
 
 # Removed old static machines endpoint - replaced with database search
@@ -283,33 +294,42 @@ def get_dataset_summary(dataset_id: str, limit: int = 100):
     Fetch a washing machine durability dataset from data.gouv.fr by its ID and return a summary.
     """
     try:
-        df = load_washing_machine_data(dataset_id)
+        df = _load_dataset_frame(dataset_id)
+        
+        # Classify columns from the dtypes alone instead of copying the frame twice with select_dtypes
+        numeric_columns = []
+        categorical_columns = []
+        for col, dtype in df.dtypes.items():
+            if is_numeric_dtype(dtype) and not is_bool_dtype(dtype):
+                numeric_columns.append(str(col))
+            elif is_object_dtype(dtype):
+                categorical_columns.append(str(col))
         
-        # Return a simplified summary
-        return {
+        # Return a simplified summary; sample rows are streamed after the metadata
+        summary = dumps({
             "success": True,
             "shape": list(df.shape),
             "columns": [str(col) for col in df.columns],
-            "sample_data": df.head(limit).to_dict(orient="records"),
             "total_rows": len(df),
             "total_columns": len(df.columns),
-            "numeric_columns": list(df.select_dtypes(include=['number']).columns),
-            "categorical_columns": list(df.select_dtypes(include=['object']).columns)
-        }
+            "numeric_columns": numeric_columns,
+            "categorical_columns": categorical_columns
+        })
+        return StreamingResponse(_stream_dataset_summary(summary, df.head(limit)), media_type="application/json")
     except Exception as e:
         raise HTTPException(status_code=404, detail=f"Failed to fetch dataset: {str(e)}")
 
 
 @router.get("/washing-machines")
-def get_washing_machine_datasets():
+def get_washing_machine_datasets(if_none_match: Optional[str] = Header(None),
+                                 accept_encoding: Optional[str] = Header(None)):
     """
     Get a comprehensive summary of all washing machine durability datasets with their resources.
     """
     try:
-        summary = get_washing_machine_datasets_summary()
+        return _cached_response("datasets", if_none_match, accept_encoding)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch washing machine datasets: {e}")
-    return json.loads(json.dumps(summary, cls=NpEncoder))
 
 
 @router.get("/test-dataset/{dataset_id}")
@@ -318,30 +338,30 @@ def test_dataset_loading(dataset_id: str):
     Test endpoint to debug dataset loading issues.
     """
     try:
-        df = load_washing_machine_data(dataset_id)
-        return {
+        df = _load_dataset_frame(dataset_id)
+        return json_response({
             "success": True,
-            "shape": df.shape,
-            "columns": list(df.columns[:5]),  # First 5 columns only
+            "shape": list(df.shape),
+            "columns": [str(col) for col in df.columns[:5]],  # First 5 columns only
             "message": "Dataset loaded successfully"
-        }
+        })
     except Exception as e:
-        return {
+        return json_response({
             "success": False,
             "error": str(e),
             "message": "Failed to load dataset"
-        }
+        })
 
 @router.get("/datasets")
-def get_all_datasets(limit: int = 100):
+def get_all_datasets(limit: int = 100, if_none_match: Optional[str] = Header(None),
+                     accept_encoding: Optional[str] = Header(None)):
     """
     Fetch a list of washing machine durability datasets from data.gouv.fr and return their metadata.
     """
     try:
-        summary = get_washing_machine_datasets_summary()
+        return _cached_response("datasets", if_none_match, accept_encoding)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch datasets: {e}")
-    return json.loads(json.dumps(summary, cls=NpEncoder))
 
 # New search endpoints for washing machines database
 
@@ -358,7 +378,10 @@ def search_machines(
     limit: int = Query(50, description="Maximum number of results"),
     offset: int = Query(0, description="Number of results to skip"),
     sort_by: str = Query("note_reparabilite", description="Field to sort by"),
-    sort_order: str = Query("DESC", description="Sort order (ASC or DESC)")
+    sort_order: str = Query("DESC", description="Sort order (ASC or DESC)"),
+    fields: Optional[str] = Query(None, description="Comma-separated columns to return (default: list columns)"),
+    after_sort: Optional[str] = Query(None, description="Keyset cursor: sort value of the last row seen (next_cursor.after_sort)"),
+    after_id: Optional[int] = Query(None, description="Keyset cursor: id of the last row seen (next_cursor.after_id); replaces offset")
 ):
     """
     Search washing machines in the local database.
@@ -367,83 +390,66 @@ def search_machines(
     - /v1/machines?q=samsung&year=2025
     - /v1/machines?min_repairability=8.0&sort_by=note_reparabilite&sort_order=DESC
     - /v1/machines?brand=LG&limit=10
+    - /v1/machines?brand=LG&fields=nom_modele,note_A_c1,note_A_c2
+    - /v1/machines?min_repairability=8.0&after_sort=8.4&after_id=1234 (next page from next_cursor)
     """
+    field_list = [f.strip() for f in fields.split(",") if f.strip()] if fields else None
     try:
         # Use real database search with enhanced logic
         try:
-            # Enhanced search logic for database
-            enhanced_min_repairability = min_repairability
-            enhanced_max_repairability = max_repairability
-            enhanced_min_reliability = min_reliability
-            enhanced_max_reliability = max_reliability
-            enhanced_sort_by = sort_by
-            enhanced_sort_order = sort_order
+            if not q:
+                # Most requests are paginated/structured filters: nothing to classify
+                return json_response(search_washing_machines(
+                    query=None,
+                    brand=brand,
+                    model=model,
+                    min_repairability=min_repairability,
+                    max_repairability=max_repairability,
+                    min_reliability=min_reliability,
+                    max_reliability=max_reliability,
+                    year=year,
+                    limit=limit,
+                    offset=offset,
+                    sort_by=sort_by,
+                    sort_order=sort_order,
+                    fields=field_list,
+                    after_sort=after_sort,
+                    after_id=after_id
+                ))
+            
+            # Enhanced search logic for database: keyword queries become filters
+            params = {
+                "min_repairability": min_repairability,
+                "max_repairability": max_repairability,
+                "min_reliability": min_reliability,
+                "max_reliability": max_reliability,
+                "sort_by": sort_by,
+                "sort_order": sort_order,
+            }
             
-            if q:
-                query_lower = q.lower()
-                # Check if it's a special filter query
-                if any(keyword in query_lower for keyword in ["réparable", "repairability", "plus réparable", "plus reparable"]):
-                    # Filter by repairability
-                    enhanced_min_repairability = 7.0
-                    enhanced_sort_by = "note_reparabilite"
-                    enhanced_sort_order = "DESC"
-                    # Clear the query parameter to avoid text search
-                    q = None
-                elif any(keyword in query_lower for keyword in ["fiable", "reliability", "plus fiable", "plus reliable"]):
-                    # Filter by reliability
-                    enhanced_min_reliability = 6.0
-                    enhanced_sort_by = "note_fiabilite"
-                    enhanced_sort_order = "DESC"
-                    # Clear the query parameter to avoid text search
-                    q = None
-                elif any(keyword in query_lower for keyword in ["durable", "durability"]):
-                    # Filter by overall durability (global score)
-                    enhanced_sort_by = "note_id"
-                    enhanced_sort_order = "DESC"
-                    # Clear the query parameter to avoid text search
-                    q = None
-                elif any(keyword in query_lower for keyword in ["excellent", "meilleur"]):
-                    # Filter for excellent machines (high scores across all categories)
-                    enhanced_min_repairability = 8.0
-                    enhanced_min_reliability = 7.0
-                    enhanced_sort_by = "note_id"
-                    enhanced_sort_order = "DESC"
-                    # Clear the query parameter to avoid text search
-                    q = None
-                elif any(keyword in query_lower for keyword in ["bon marché", "économique"]):
-                    # Filter for affordable machines (lower scores but still decent)
-                    enhanced_max_repairability = 6.0
-                    enhanced_max_reliability = 6.0
-                    enhanced_sort_by = "note_id"
-                    enhanced_sort_order = "DESC"
-                    # Clear the query parameter to avoid text search
-                    q = None
-                elif any(keyword in query_lower for keyword in ["hublot", "top", "front", "charge"]):
-                    # Filter by loading type - use general search
-                    pass
-                else:
-                    # General text search - use existing q parameter
-                    pass
+            overrides = _INTENT_OVERRIDES.get(_classify_intent(q.lower()))
+            if overrides:
+                params.update(overrides, sort_order="DESC")
+                # Clear the query parameter to avoid text search
+                q = None
             
-            return search_washing_machines(
+            return json_response(search_washing_machines(
                 query=q,
                 brand=brand,
                 model=model,
-                min_repairability=enhanced_min_repairability,
-                max_repairability=enhanced_max_repairability,
-                min_reliability=enhanced_min_reliability,
-                max_reliability=enhanced_max_reliability,
                 year=year,
                 limit=limit,
                 offset=offset,
-                sort_by=enhanced_sort_by,
-                sort_order=enhanced_sort_order
-            )
+                fields=field_list,
+                after_sort=after_sort,
+                after_id=after_id,
+                **params
+            ))
         except Exception as e:
             # Fallback to mock data if database fails
             logger.error(f"Database search failed, falling back to mock data: {e}")
-            return get_mock_search_results(q, brand, model, min_repairability, max_repairability, 
-                                        min_reliability, max_reliability, year, limit, offset, sort_by, sort_order)
+            return json_response(get_mock_search_results(q, brand, model, min_repairability, max_repairability, 
+                                        min_reliability, max_reliability, year, limit, offset, sort_by, sort_order))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Search failed: {str(e)}")
 
@@ -457,57 +463,60 @@ def get_machine(machine_id: int):
         machine = get_machine_details(machine_id)
         if machine is None:
             raise HTTPException(status_code=404, detail="Machine not found")
-        return machine
+        return json_response(machine)
     except HTTPException:
         raise
     except Exception as e:
         # Fallback to mock data if database fails
         logger.error(f"Database query failed, falling back to mock data: {e}")
-        machine = next((m for m in MOCK_MACHINES if m["id"] == machine_id), None)
+        machine = next((m for m in _mock_machines() if m["id"] == machine_id), None)
         if machine is None:
             raise HTTPException(status_code=404, detail="Machine not found")
-        return machine
+        return json_response(machine)
 
 @router.get("/brands")
-def get_all_brands():
+def get_all_brands(if_none_match: Optional[str] = Header(None),
+                   accept_encoding: Optional[str] = Header(None)):
     """
     Get list of all unique brands/manufacturers.
     """
     try:
         # Try to get brands from database
-        return {"brands": get_brands()}
+        return _cached_response("brands", if_none_match, accept_encoding)
     except Exception as e:
         # Fallback to mock data if database fails
         logger.error(f"Database query failed, falling back to mock data: {e}")
-        brands = list(set(m["nom_metteur_sur_le_marche"] for m in MOCK_MACHINES))
-        return {"brands": brands}
+        brands = list(set(m["nom_metteur_sur_le_marche"] for m in _mock_machines()))
+        return json_response({"brands": brands})
 
 @router.get("/statistics")
-def get_db_statistics():
+def get_db_statistics(if_none_match: Optional[str] = Header(None),
+                      accept_encoding: Optional[str] = Header(None)):
     """
     Get statistics about the washing machines database.
     """
     try:
         # Try to get statistics from database
-        return get_statistics()
+        return _cached_response("statistics", if_none_match, accept_encoding)
     except Exception as e:
         # Fallback to mock data if database fails
         logger.error(f"Database query failed, falling back to mock data: {e}")
-        repairability_scores = [m["note_reparabilite"] for m in MOCK_MACHINES]
-        reliability_scores = [m["note_fiabilite"] for m in MOCK_MACHINES]
+        mock = _mock_columns()
+        mock_machines = _mock_machines()
         
+        # One NumPy reduction per aggregate over the precomputed score columns
         stats = {
-            "total_machines": len(MOCK_MACHINES),
-            "total_brands": len(set(m["nom_metteur_sur_le_marche"] for m in MOCK_MACHINES)),
-            "avg_repairability": sum(repairability_scores) / len(repairability_scores),
-            "avg_reliability": sum(reliability_scores) / len(reliability_scores),
-            "min_repairability": min(repairability_scores),
-            "max_repairability": max(repairability_scores),
-            "min_reliability": min(reliability_scores),
-            "max_reliability": max(reliability_scores)
+            "total_machines": len(mock.df),
+            "total_brands": int(mock.df["nom_metteur_sur_le_marche"].nunique()),
+            "avg_repairability": float(mock.rep.mean()),
+            "avg_reliability": float(mock.fia.mean()),
+            "min_repairability": float(mock.rep.min()),
+            "max_repairability": float(mock.rep.max()),
+            "min_reliability": float(mock.fia.min()),
+            "max_reliability": float(mock.fia.max())
         }
         
-        return {
+        return json_response({
             "statistics": stats,
             "top_brands_by_repairability": [
                 {
@@ -515,6 +524,6 @@ def get_db_statistics():
                     "avg_repairability": m["note_reparabilite"],
                     "machine_count": 1
                 }
-                for m in MOCK_MACHINES
+                for m in mock_machines
             ]
-        } 
\ No newline at end of file
+        }) 
\ No newline at end of file
@@ -1,6 +1,11 @@
+import fcntl
 import os
+import shutil
+import threading
+import time
 import duckdb
-from typing import Optional
+from contextlib import contextmanager
+from typing import Callable, Iterator, List, Optional
 
 
 def get_duckdb_path() -> str:
@@ -9,10 +14,216 @@ def get_duckdb_path() -> str:
     return db_path
 
 
-def get_connection(readonly: bool = False):
-    """Return a DuckDB connection to the on-disk database file."""
-    db_path = get_duckdb_path()
+def _connect(db_path: str, readonly: bool = False):
     conn = duckdb.connect(db_path, read_only=readonly)
     conn.execute("PRAGMA threads=4")
     conn.execute("PRAGMA memory_limit='1GB'")
     return conn
+
+
+def get_connection(readonly: bool = False):
+    """Return a DuckDB connection to the on-disk database file.
+
+    A read-write connection can't be opened while the API is up (it holds the file
+    for its whole lifetime); scripts that write use write_connection instead.
+    """
+    return _connect(get_duckdb_path(), readonly)
+
+
+@contextmanager
+def write_connection(db_path: Optional[str] = None) -> Iterator[duckdb.DuckDBPyConnection]:
+    """Read-write connection on a private copy of the database, swapped in on success.
+
+    The API keeps a read-only handle on the database file open, which DuckDB's file
+    lock makes exclusive of any read-write connection from another process. Writers
+    therefore work on a copy next to the file and os.replace() it over the original
+    when the block exits cleanly; the API picks the new file up by its identity
+    (see _refresh_shared_connection). On error the copy is discarded. Writers are
+    serialized by a lock file, so a second writer waits for the first to finish
+    instead of having its changes overwritten.
+    """
+    db_path = db_path or get_duckdb_path()
+    os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+    work_path = f"{db_path}.writing"
+    with open(f"{db_path}.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            for path in (work_path, f"{work_path}.wal"):
+                # Left over by a writer that was killed mid-run
+                if os.path.exists(path):
+                    os.remove(path)
+            if os.path.exists(db_path):
+                shutil.copyfile(db_path, work_path)
+                if os.path.exists(f"{db_path}.wal"):
+                    shutil.copyfile(f"{db_path}.wal", f"{work_path}.wal")
+            conn = _connect(work_path)
+            try:
+                yield conn
+                # Fold the WAL into the file so the copy is complete on its own
+                conn.execute("CHECKPOINT")
+            finally:
+                conn.close()
+            if os.path.exists(f"{db_path}.wal"):
+                # Already replayed into the copy; left in place it would be applied again
+                os.remove(f"{db_path}.wal")
+            os.replace(work_path, db_path)
+        finally:
+            for path in (work_path, f"{work_path}.wal"):
+                if os.path.exists(path):
+                    os.remove(path)
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+# Lowercased copies ("<col>_lc") of the free-text search columns, so searches run a
+# plain substring match instead of case-folding every row with ILIKE
+SEARCH_TEXT_COLUMNS = ("nom_modele", "nom_metteur_sur_le_marche")
+
+
+def refresh_search_columns(conn) -> None:
+    """Add (if needed) and fill the lowercased search columns; run after loading rows."""
+    for col in SEARCH_TEXT_COLUMNS:
+        conn.execute(f"ALTER TABLE washing_machines ADD COLUMN IF NOT EXISTS {col}_lc VARCHAR")
+    assignments = ", ".join(f"{col}_lc = lower({col})" for col in SEARCH_TEXT_COLUMNS)
+    conn.execute(f"UPDATE washing_machines SET {assignments}")
+
+
+# Per-brand repairability aggregates, precomputed at ingest for /statistics
+BRAND_STATS_TABLE = "wm_brand_stats"
+
+
+def refresh_brand_stats(conn) -> None:
+    """Rebuild the per-brand aggregates table; run after loading rows."""
+    conn.execute(
+        f"""
+        CREATE OR REPLACE TABLE {BRAND_STATS_TABLE} AS
+        SELECT
+            nom_metteur_sur_le_marche,
+            AVG(note_reparabilite) AS avg_repairability,
+            COUNT(*) AS machine_count
+        FROM washing_machines
+        WHERE note_reparabilite IS NOT NULL
+        GROUP BY nom_metteur_sur_le_marche
+        """
+    )
+
+
+# Default /machines ordering; rows are stored in this order so the row groups
+# carry tight min/max ranges on note_reparabilite and the top-N sort for the
+# first pages stays cheap
+DEFAULT_SORT_KEY = "note_reparabilite DESC NULLS LAST, id DESC"
+
+
+def _index_definitions(conn) -> List[tuple]:
+    return conn.execute(
+        "SELECT index_name, sql FROM duckdb_indexes() WHERE table_name = 'washing_machines'"
+    ).fetchall()
+
+
+def drop_indexes(conn) -> List[str]:
+    """Drop washing_machines' indexes and return their CREATE statements, so a bulk
+    load doesn't maintain them row by row; pass the result to restore_indexes."""
+    index_sql = []
+    for name, sql in _index_definitions(conn):
+        conn.execute(f'DROP INDEX "{name}"')
+        if sql:
+            index_sql.append(sql)
+    return index_sql
+
+
+def restore_indexes(conn, index_sql: List[str]) -> None:
+    """Recreate indexes dropped by drop_indexes, each built once over the loaded table."""
+    for sql in index_sql:
+        conn.execute(sql)
+
+
+def cluster_by_default_sort(conn) -> None:
+    """Rewrite washing_machines in DEFAULT_SORT_KEY order; run after loading rows."""
+    # CREATE OR REPLACE drops the table's indexes, so replay their definitions
+    index_sql = [sql for _, sql in _index_definitions(conn) if sql]
+    conn.begin()
+    try:
+        conn.execute(
+            "CREATE OR REPLACE TABLE washing_machines AS "
+            f"SELECT * FROM washing_machines ORDER BY {DEFAULT_SORT_KEY}"
+        )
+        for sql in index_sql:
+            conn.execute(sql)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+# Read-only connection shared by the API process; opened once so the catalog
+# and buffer pool stay warm across requests. While it is open no other process
+# can connect read-write, which is why writers go through write_connection.
+_shared_conn: Optional[duckdb.DuckDBPyConnection] = None
+_shared_lock = threading.Lock()
+# Identity of the file the shared connection was opened on, so a database
+# replaced on disk (rebuild, copy from prod) is picked up without a restart
+_shared_file_id: Optional[tuple] = None
+_next_file_check = 0.0
+FILE_CHECK_INTERVAL = 5.0
+# Called after the shared connection is reopened on a replaced file, so
+# in-process caches of query results don't outlive the data they came from
+_reload_callbacks: List[Callable[[], None]] = []
+
+
+def on_database_reload(callback: Callable[[], None]) -> None:
+    """Register callback to run whenever the shared connection picks up a new database file."""
+    _reload_callbacks.append(callback)
+
+
+def _file_id(path: str) -> Optional[tuple]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_dev, st.st_ino, st.st_mtime_ns)
+
+
+def open_shared_connection() -> duckdb.DuckDBPyConnection:
+    """Open (or return) the process-wide read-only connection."""
+    global _shared_conn, _shared_file_id
+    with _shared_lock:
+        if _shared_conn is None:
+            _shared_conn = get_connection(readonly=True)
+            _shared_file_id = _file_id(get_duckdb_path())
+        return _shared_conn
+
+
+def close_shared_connection() -> None:
+    global _shared_conn
+    with _shared_lock:
+        if _shared_conn is not None:
+            _shared_conn.close()
+            _shared_conn = None
+
+
+def _refresh_shared_connection() -> duckdb.DuckDBPyConnection:
+    """Reopen the shared connection if the database file was replaced since it was opened."""
+    global _shared_conn, _next_file_check
+    reloaded = False
+    with _shared_lock:
+        _next_file_check = time.monotonic() + FILE_CHECK_INTERVAL
+        if _shared_conn is not None and _file_id(get_duckdb_path()) != _shared_file_id:
+            # DuckDB caches open databases by path, so the old one must be closed
+            # before reconnecting; a query caught mid-flight fails into the mock fallback
+            _shared_conn.close()
+            _shared_conn = None
+            reloaded = True
+    conn = open_shared_connection()
+    if reloaded:
+        for callback in _reload_callbacks:
+            callback()
+    return conn
+
+
+def get_read_cursor() -> duckdb.DuckDBPyConnection:
+    """Return a cursor on the shared read-only connection (one per request/thread)."""
+    # Lock-free once the lifespan handler has opened the connection, except for a
+    # file check every FILE_CHECK_INTERVAL seconds
+    conn = _shared_conn
+    if conn is None or time.monotonic() >= _next_file_check:
+        conn = _refresh_shared_connection()
+    return conn.cursor()
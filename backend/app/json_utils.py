@@ -0,0 +1,31 @@
+from decimal import Decimal
+
+import numpy as np
+import orjson
+from fastapi import Response
+
+
+def orjson_default(obj):
+    """Fallback for types orjson does not encode natively."""
+    # NumPy scalars/arrays not covered by OPT_SERIALIZE_NUMPY (e.g. float16, object arrays)
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    # DuckDB returns DECIMAL columns (amazon_price_eur) as Decimal; keep them numeric
+    if isinstance(obj, Decimal):
+        return float(obj)
+    return str(obj)
+
+
+def dumps(content) -> bytes:
+    return orjson.dumps(
+        content,
+        default=orjson_default,
+        option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS,
+    )
+
+
+def json_response(content) -> Response:
+    """Serialize with orjson (NumPy-aware) and skip FastAPI's own encoding pass."""
+    return Response(content=dumps(content), media_type="application/json")
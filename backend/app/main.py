@@ -1,26 +1,38 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.gzip import GZipMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
+from starlette.datastructures import MutableHeaders
+import os
 import time
 from contextlib import asynccontextmanager
 
 from .api import router
+from .amazon_lookup import close_session
+from .duckdb_utils import open_shared_connection, close_shared_connection
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
     print("🚀 Starting up washing machine durability API...")
+    try:
+        open_shared_connection()
+    except Exception as e:
+        # Endpoints fall back to mock data; the connection is retried on first use
+        print(f"⚠️  DuckDB not available at startup: {e}")
     yield
     # Shutdown
+    await close_session()
+    close_shared_connection()
     print("👋 Shutting down washing machine durability API...")
 
 app = FastAPI(
     title="Washing Machine Durability API",
     description="API for searching and analyzing washing machine durability data",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 # Add CORS middleware
@@ -41,8 +53,10 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Add compression middleware
-app.add_middleware(GZipMiddleware, minimum_size=1000)
+# Add compression middleware for dynamic responses; cached catalog bodies arrive
+# precompressed (br/gzip) and are passed through. Level 6 instead of the default 9:
+# near-identical ratio on JSON for much less CPU per request
+app.add_middleware(GZipMiddleware, minimum_size=1000, compresslevel=6)
 
 # Add trusted host middleware for security
 app.add_middleware(
@@ -58,23 +72,42 @@ app.add_middleware(
 )
 
 # Add custom middleware for performance monitoring
-@app.middleware("http")
-async def add_process_time_header(request, call_next):
-    start_time = time.time()
-    response = await call_next(request)
-    process_time = time.time() - start_time
-    response.headers["X-Process-Time"] = str(process_time)
-    
-    # Only add caching headers on successful GET API responses
-    if (
-        request.url.path.startswith("/v1/")
-        and request.method == "GET"
-        and 200 <= response.status_code < 400
-    ):
-        response.headers["Cache-Control"] = "public, max-age=300, stale-while-revalidate=600"
-        # Do not attempt to compute ETag for streaming responses
-    
-    return response
+class ProcessTimeMiddleware:
+    """Pure ASGI middleware: sets timing and caching headers on the response start message
+    without the extra task and body re-wrapping of @app.middleware("http")."""
+
+    def __init__(self, app, expose_timing: bool = True):
+        self.app = app
+        self.expose_timing = expose_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start_ns = time.perf_counter_ns()
+        # Only add caching headers on successful GET API responses
+        cacheable = scope["path"].startswith("/v1/") and scope["method"] == "GET"
+
+        async def send_with_headers(message):
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                if self.expose_timing:
+                    # Integer microseconds: monotonic clock, no float formatting
+                    headers["X-Process-Time"] = f"{(time.perf_counter_ns() - start_ns) // 1000}us"
+                if cacheable and 200 <= message["status"] < 400:
+                    headers["Cache-Control"] = "public, max-age=300, stale-while-revalidate=600"
+                    # ETags are set by the cached endpoints themselves (hashed once per cache fill);
+                    # do not attempt to compute one here for streaming responses
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
+
+
+app.add_middleware(
+    ProcessTimeMiddleware,
+    expose_timing=os.environ.get("EXPOSE_PROCESS_TIME", "1") != "0",
+)
 
 # Add health check endpoint
 @app.get("/health")
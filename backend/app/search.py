@@ -2,20 +2,43 @@
 Search functionality for washing machines database using DuckDB.
 """
 
-from typing import List, Dict, Any, Optional
+import datetime
+from functools import lru_cache
+from typing import List, Dict, Any, Optional, Tuple
 import logging
-import re
-import duckdb
+from cachetools.func import ttl_cache
 
-from .duckdb_utils import get_connection
-import datetime
+from .duckdb_utils import BRAND_STATS_TABLE, SEARCH_TEXT_COLUMNS, get_read_cursor, on_database_reload
 
 logger = logging.getLogger(__name__)
 
 
-def _sanitize_like(value: str) -> str:
-    # DuckDB uses ILIKE for case-insensitive matches, but Python parameterization will handle quoting
-    return f"%{value}%"
+@ttl_cache(maxsize=1, ttl=300)
+def _has_search_columns() -> bool:
+    conn = get_read_cursor()
+    found = conn.execute(
+        "SELECT COUNT(*) FROM information_schema.columns "
+        "WHERE table_name = 'washing_machines' AND column_name IN (SELECT unnest(?))",
+        [[f"{col}_lc" for col in SEARCH_TEXT_COLUMNS]],
+    ).fetchone()[0]
+    return found == len(SEARCH_TEXT_COLUMNS)
+
+
+@ttl_cache(maxsize=1, ttl=300)
+def _has_brand_stats() -> bool:
+    conn = get_read_cursor()
+    return conn.execute(
+        "SELECT COUNT(*) FROM information_schema.tables WHERE table_name = ?",
+        [BRAND_STATS_TABLE],
+    ).fetchone()[0] > 0
+
+
+def _contains_ci(column: str) -> str:
+    """Case-insensitive substring predicate on column; bind the lowercased needle"""
+    if _has_search_columns():
+        # Rows loaded since the last refresh_search_columns() have no copy yet
+        return f"contains(COALESCE({column}_lc, lower({column})), ?)"
+    return f"contains(lower({column}), ?)"
 
 
 def _build_where_and_params(
@@ -32,17 +55,17 @@ def _build_where_and_params(
     params: list[Any] = []
 
     if query:
-        conditions.append("(nom_modele ILIKE ? OR nom_metteur_sur_le_marche ILIKE ?)")
-        like = _sanitize_like(query)
-        params.extend([like, like])
+        conditions.append(f"({_contains_ci('nom_modele')} OR {_contains_ci('nom_metteur_sur_le_marche')})")
+        needle = query.lower()
+        params.extend([needle, needle])
 
     if brand:
-        conditions.append("nom_metteur_sur_le_marche ILIKE ?")
-        params.append(_sanitize_like(brand))
+        conditions.append(_contains_ci("nom_metteur_sur_le_marche"))
+        params.append(brand.lower())
 
     if model:
-        conditions.append("nom_modele ILIKE ?")
-        params.append(_sanitize_like(model))
+        conditions.append(_contains_ci("nom_modele"))
+        params.append(model.lower())
 
     if min_repairability is not None:
         conditions.append("note_reparabilite >= ?")
@@ -61,14 +84,110 @@ def _build_where_and_params(
         params.append(max_reliability)
 
     if year is not None:
-        # Cast date to year; DuckDB supports EXTRACT(YEAR FROM col)
-        conditions.append("EXTRACT(YEAR FROM date_calcul) = ?")
-        params.append(year)
+        if datetime.MINYEAR <= year < datetime.MAXYEAR:
+            # Half-open range on the raw column instead of EXTRACT(YEAR ...), so
+            # DuckDB can skip row groups using the min/max statistics of date_calcul
+            conditions.append("date_calcul >= ? AND date_calcul < ?")
+            params.extend([datetime.date(year, 1, 1), datetime.date(year + 1, 1, 1)])
+        else:
+            conditions.append("FALSE")
 
     where_clause = " AND ".join(conditions) if conditions else "1=1"
     return where_clause, params
 
 
+# Columns returned by list searches: what the result cards render. DuckDB never
+# reads the columns a query does not reference, so sub-scores and parts stay on disk
+LIST_COLUMNS = (
+    "id",
+    "id_unique",
+    "nom_modele",
+    "nom_metteur_sur_le_marche",
+    "date_calcul",
+    "note_reparabilite",
+    "note_fiabilite",
+    "note_id",
+    "categorie_produit",
+    "amazon_asin",
+    "amazon_product_url",
+    "amazon_image_url",
+    "amazon_price_eur",
+    "amazon_product_title",
+)
+
+# Extra columns a caller may request through `fields`
+OPTIONAL_LIST_COLUMNS = (
+    "url_tableau_detail_notation",
+    "note_A_c1", "note_A_c2", "note_A_c3", "note_A_c4",
+    "note_B_c1", "note_B_c2", "note_B_c3",
+    "nom_piece_1_liste_2", "nom_piece_2_liste_2", "nom_piece_3_liste_2",
+    "nom_piece_4_liste_2", "nom_piece_5_liste_2",
+)
+
+_ALLOWED_FIELDS = frozenset(LIST_COLUMNS + OPTIONAL_LIST_COLUMNS)
+
+
+def _select_columns(fields: Optional[List[str]]) -> Tuple[str, ...]:
+    """Validated projection: `fields` (whitelisted, order kept) or the list default; id is always included"""
+    if not fields:
+        return LIST_COLUMNS
+    columns = [f for f in dict.fromkeys(fields) if f in _ALLOWED_FIELDS and f != "id"]
+    return ("id", *columns)
+
+
+# Accepted sort_by values and the SQL each one orders by; anything else falls back
+# to note_reparabilite. Fixed strings keep the statement text stable per sort
+_SORT_EXPRESSIONS = {
+    "id": "id",
+    "nom_modele": "nom_modele",
+    "nom_metteur_sur_le_marche": "nom_metteur_sur_le_marche",
+    "note_reparabilite": "note_reparabilite",
+    "note_fiabilite": "note_fiabilite",
+    "date_calcul": "date_calcul",
+    "note_id": "note_id",
+    "amazon_price_eur": "amazon_price_eur",
+    # Computed value metric: price per durability point
+    "price_per_durability": "(amazon_price_eur / NULLIF(note_id, 0))",
+}
+
+
+@lru_cache(maxsize=512)
+def _search_statements(where_clause: str, sort_expression: str, sort_order: str,
+                       columns: Tuple[str, ...] = LIST_COLUMNS,
+                       windowed: bool = False) -> Tuple[str, str]:
+    """COUNT and page SELECT for one filter shape and sort; the WHERE clause only varies
+    with which filters are set (values are bound), so the SQL text is built once per shape.
+
+    The page SELECT returns hidden trailing columns: _sort_key (the sort value, for
+    next_cursor) and, with `windowed`, _total (the filtered total, so the WHERE clause
+    is evaluated once)."""
+    count_sql = f"SELECT COUNT(*) AS cnt FROM washing_machines WHERE {where_clause}"
+    total_column = ", COUNT(*) OVER () AS _total" if windowed else ""
+    # id breaks ties so pages are stable and a (sort value, id) cursor is exact
+    select_sql = f"""
+        SELECT {", ".join(columns)}, {sort_expression} AS _sort_key{total_column}
+        FROM washing_machines
+        WHERE {where_clause}
+        ORDER BY {sort_expression} {sort_order} NULLS LAST, id {sort_order}
+        LIMIT ? OFFSET ?
+    """
+    return count_sql, select_sql
+
+
+def _keyset_condition(sort_expression: str, sort_order: str,
+                      after_sort: Any, after_id: int) -> Tuple[str, list]:
+    """Rows strictly after the cursor (after_sort, after_id) in the page order; NULL
+    sort values come last in both directions"""
+    cmp = "<" if sort_order == "DESC" else ">"
+    if after_sort is None:
+        return f"({sort_expression} IS NULL AND id {cmp} ?)", [after_id]
+    return (
+        f"({sort_expression} {cmp} ? OR {sort_expression} IS NULL "
+        f"OR ({sort_expression} = ? AND id {cmp} ?))",
+        [after_sort, after_sort, after_id],
+    )
+
+
 def search_washing_machines(
     query: Optional[str] = None,
     brand: Optional[str] = None,
@@ -82,138 +201,138 @@ def search_washing_machines(
     offset: int = 0,
     sort_by: str = "note_reparabilite",
     sort_order: str = "DESC",
+    fields: Optional[List[str]] = None,
+    after_sort: Any = None,
+    after_id: Optional[int] = None,
 ) -> Dict[str, Any]:
     """Search washing machines in DuckDB.
 
-    Returns a dict with keys: machines, total, limit, offset, has_more
+    `fields` narrows or extends the returned columns (see LIST_COLUMNS and
+    OPTIONAL_LIST_COLUMNS); unknown names are ignored.
+
+    Passing `after_id` (with `after_sort`, the sort value of that row, None if
+    it had none) switches to keyset pagination: the page starts right after
+    that row and `offset` is ignored, so deep pages don't scan and discard the
+    rows before them. Every page that has more rows returns the cursor for the
+    next one as next_cursor.
+
+    Returns a dict with keys: machines, total, limit, offset, has_more, next_cursor
     """
     try:
-        conn = get_connection(readonly=True)
-
-        allowed_sort_fields = {
-            "id",
-            "nom_modele",
-            "nom_metteur_sur_le_marche",
-            "note_reparabilite",
-            "note_fiabilite",
-            "date_calcul",
-            "note_id",
-            "amazon_price_eur",
-            "price_per_durability",
-        }
-        if sort_by not in allowed_sort_fields:
-            sort_by = "note_reparabilite"
-        sort_order = "DESC" if str(sort_order).upper() == "DESC" else "ASC"
+        conn = get_read_cursor()
+
+        sort_expression = _SORT_EXPRESSIONS.get(sort_by, _SORT_EXPRESSIONS["note_reparabilite"])
+        if sort_order not in ("DESC", "ASC"):
+            # Already-canonical values (the default, and what the frontend sends) skip this
+            sort_order = "DESC" if str(sort_order).upper() == "DESC" else "ASC"
 
         where_clause, params = _build_where_and_params(
             query, brand, model, min_repairability, max_repairability,
             min_reliability, max_reliability, year
         )
 
-        count_sql = f"SELECT COUNT(*) AS cnt FROM washing_machines WHERE {where_clause}"
-        total_count = conn.execute(count_sql, params).fetchone()[0]
-
-        # Map sort_by to SQL (support computed metric for value)
-        sort_expression = sort_by
-        if sort_by == "price_per_durability":
-            sort_expression = "(amazon_price_eur / NULLIF(note_id, 0))"
-
-        select_sql = f"""
-            SELECT
-                id,
-                id_unique,
-                nom_modele,
-                nom_metteur_sur_le_marche,
-                date_calcul,
-                note_reparabilite,
-                note_fiabilite,
-                note_id,
-                categorie_produit,
-                url_tableau_detail_notation,
-                note_A_c1, note_A_c2, note_A_c3, note_A_c4,
-                note_B_c1, note_B_c2, note_B_c3,
-                nom_piece_1_liste_2, nom_piece_2_liste_2, nom_piece_3_liste_2,
-                nom_piece_4_liste_2, nom_piece_5_liste_2,
-                amazon_asin,
-                amazon_product_url,
-                amazon_image_url,
-                amazon_price_eur,
-                amazon_product_title
-            FROM washing_machines
-            WHERE {where_clause}
-            ORDER BY {sort_expression} {sort_order}
-            LIMIT ? OFFSET ?
-        """
-        rows = conn.execute(select_sql, params + [limit, offset]).fetchall()
-        cols = [d[0] for d in conn.description]
-        machines = [dict(zip(cols, r)) for r in rows]
-
-        # Ensure ISO date strings; handle str or date/datetime
-        for m in machines:
-            d = m.get("date_calcul")
-            if d is None:
-                continue
-            if isinstance(d, (datetime.date, datetime.datetime)):
-                m["date_calcul"] = d.isoformat()
-            elif isinstance(d, str):
-                # Leave as-is if already a string
-                m["date_calcul"] = d
+        keyset = after_id is not None
+        if keyset:
+            offset = 0
+            cursor_clause, cursor_params = _keyset_condition(
+                sort_expression, sort_order, after_sort, after_id
+            )
+            page_where = f"{where_clause} AND {cursor_clause}"
+            page_params = params + cursor_params
+        else:
+            page_where, page_params = where_clause, params
+
+        # Substring filters make the scan expensive enough that one windowed query
+        # beats COUNT + SELECT; for numeric-only filters the window's full
+        # materialization costs more than the second (cheap) scan. A keyset page
+        # only sees the rows after the cursor, so its window can't give the total
+        windowed = bool(query or brand or model) and not keyset
+        columns = _select_columns(fields)
+        count_sql, _ = _search_statements(where_clause, sort_expression, sort_order, columns)
+        _, select_sql = _search_statements(page_where, sort_expression, sort_order, columns, windowed)
+
+        if windowed:
+            rows = conn.execute(select_sql, page_params + [limit, offset]).fetchall()
+            if rows:
+                total_count = rows[0][-1]
+            else:
+                # Empty page: only a page past the end can still have matches
+                total_count = conn.execute(count_sql, params).fetchone()[0] if offset else 0
+            has_more = offset + limit < total_count
+        else:
+            total_count = conn.execute(count_sql, params).fetchone()[0]
+            # One extra row tells a keyset page whether another one follows
+            rows = conn.execute(select_sql, page_params + [limit + keyset, offset]).fetchall()
+            has_more = len(rows) > limit if keyset else offset + limit < total_count
+            rows = rows[:limit]
+
+        next_cursor = None
+        if has_more and rows:
+            next_cursor = {"after_sort": rows[-1][len(columns)], "after_id": rows[-1][0]}
+        # date_calcul stays a datetime.date: orjson writes dates as ISO strings natively,
+        # so no second per-row pass is needed before encoding
+        machines = [dict(zip(columns, r)) for r in rows]
 
         return {
             "machines": machines,
             "total": total_count,
             "limit": limit,
             "offset": offset,
-            "has_more": offset + limit < total_count,
+            "has_more": has_more,
+            "next_cursor": next_cursor,
         }
     except Exception as e:
         logger.error(f"Error searching washing machines (duckdb): {e}")
         raise
 
 
+# Columns of the full record returned by get_machine_details: every notation
+# field, without the search helper columns or the Amazon enrichment
+DETAIL_COLUMNS = (
+    "id",
+    "id_unique",
+    "nom_modele",
+    "nom_metteur_sur_le_marche",
+    "date_calcul",
+    "note_reparabilite",
+    "note_fiabilite",
+    "note_id",
+    "categorie_produit",
+    "url_tableau_detail_notation",
+    "accessibilite_compteur_usage",
+    "lien_documentation_professionnels",
+    "lien_documentation_particuliers",
+    "note_A_c1", "note_A_c2", "note_A_c3", "note_A_c4",
+    "note_B_c1", "note_B_c2", "note_B_c3",
+    "nom_piece_1_liste_2", "nom_piece_2_liste_2", "nom_piece_3_liste_2",
+    "nom_piece_4_liste_2", "nom_piece_5_liste_2",
+    "etape_demontage_piece_1_liste_2", "etape_demontage_piece_2_liste_2",
+    "etape_demontage_piece_3_liste_2", "etape_demontage_piece_4_liste_2",
+    "etape_demontage_piece_5_liste_2",
+)
+
+# Built once: the statement text is identical on every call
+_MACHINE_DETAIL_SQL = f"SELECT {', '.join(DETAIL_COLUMNS)} FROM washing_machines WHERE id = ?"
+
+
 def get_machine_details(machine_id: int) -> Optional[Dict[str, Any]]:
     try:
-        conn = get_connection(readonly=True)
-        sql = """
-            SELECT 
-                id,
-                id_unique,
-                nom_modele,
-                nom_metteur_sur_le_marche,
-                date_calcul,
-                note_reparabilite,
-                note_fiabilite,
-                note_id,
-                categorie_produit,
-                url_tableau_detail_notation,
-                accessibilite_compteur_usage,
-                lien_documentation_professionnels,
-                lien_documentation_particuliers,
-                note_A_c1, note_A_c2, note_A_c3, note_A_c4,
-                note_B_c1, note_B_c2, note_B_c3,
-                nom_piece_1_liste_2, nom_piece_2_liste_2, nom_piece_3_liste_2,
-                nom_piece_4_liste_2, nom_piece_5_liste_2,
-                etape_demontage_piece_1_liste_2, etape_demontage_piece_2_liste_2,
-                etape_demontage_piece_3_liste_2, etape_demontage_piece_4_liste_2,
-                etape_demontage_piece_5_liste_2
-            FROM washing_machines WHERE id = ?
-        """
-        res = conn.execute(sql, [machine_id]).fetchone()
+        conn = get_read_cursor()
+        res = conn.execute(_MACHINE_DETAIL_SQL, [machine_id]).fetchone()
         if not res:
             return None
-        cols = [d[0] for d in conn.description]
-        m = dict(zip(cols, res))
-        if m.get("date_calcul") is not None:
-            m["date_calcul"] = m["date_calcul"].isoformat()
-        return m
+        # date_calcul stays a datetime.date, encoded as ISO by orjson like the list results
+        return dict(zip(DETAIL_COLUMNS, res))
     except Exception as e:
         logger.error(f"Error getting machine details (duckdb): {e}")
         raise
 
 
+# Catalog-style results; not cached here, api caches the serialized responses
+# (_cached_payload) so the data is held and expires in one place
 def get_brands() -> List[str]:
     try:
-        conn = get_connection(readonly=True)
+        conn = get_read_cursor()
         sql = (
             "SELECT DISTINCT nom_metteur_sur_le_marche "
             "FROM washing_machines "
@@ -230,9 +349,30 @@ def get_brands() -> List[str]:
 
 def get_statistics() -> Dict[str, Any]:
     try:
-        conn = get_connection(readonly=True)
-        stats_row = conn.execute(
+        conn = get_read_cursor()
+        if _has_brand_stats():
+            # Aggregated at ingest (refresh_brand_stats): a scan of one row per brand
+            brand_stats = f"SELECT * FROM {BRAND_STATS_TABLE} WHERE machine_count >= 2"
+        else:
+            brand_stats = """
+                SELECT 
+                    nom_metteur_sur_le_marche,
+                    AVG(note_reparabilite) as avg_repairability,
+                    COUNT(*) as machine_count
+                FROM washing_machines
+                WHERE note_reparabilite IS NOT NULL
+                GROUP BY nom_metteur_sur_le_marche
+                HAVING COUNT(*) >= 2
             """
+        # One round trip: the global aggregates and the top-brands ranking are
+        # computed in the same statement, the ranking returned as a list of structs
+        row = conn.execute(
+            f"""
+            WITH top_brands AS (
+                SELECT * FROM ({brand_stats})
+                ORDER BY avg_repairability DESC
+                LIMIT 10
+            )
             SELECT 
                 COUNT(*) as total_machines,
                 COUNT(DISTINCT nom_metteur_sur_le_marche) as total_brands,
@@ -241,31 +381,26 @@ def get_statistics() -> Dict[str, Any]:
                 MIN(note_reparabilite) as min_repairability,
                 MAX(note_reparabilite) as max_repairability,
                 MIN(note_fiabilite) as min_reliability,
-                MAX(note_fiabilite) as max_reliability
+                MAX(note_fiabilite) as max_reliability,
+                (
+                    SELECT list(
+                        {{
+                            'nom_metteur_sur_le_marche': nom_metteur_sur_le_marche,
+                            'avg_repairability': avg_repairability,
+                            'machine_count': machine_count
+                        }}
+                        ORDER BY avg_repairability DESC
+                    )
+                    FROM top_brands
+                ) as top_brands
             FROM washing_machines
             WHERE note_reparabilite IS NOT NULL AND note_fiabilite IS NOT NULL
             """
         ).fetchone()
 
         cols = [d[0] for d in conn.description]
-        stats = dict(zip(cols, stats_row))
-
-        top_rows = conn.execute(
-            """
-            SELECT 
-                nom_metteur_sur_le_marche,
-                AVG(note_reparabilite) as avg_repairability,
-                COUNT(*) as machine_count
-            FROM washing_machines
-            WHERE note_reparabilite IS NOT NULL
-            GROUP BY nom_metteur_sur_le_marche
-            HAVING COUNT(*) >= 2
-            ORDER BY avg_repairability DESC
-            LIMIT 10
-            """
-        ).fetchall()
-        top_cols = [d[0] for d in conn.description]
-        top_brands = [dict(zip(top_cols, r)) for r in top_rows]
+        stats = dict(zip(cols, row))
+        top_brands = stats.pop("top_brands") or []
 
         return {
             "statistics": stats,
@@ -273,4 +408,12 @@ def get_statistics() -> Dict[str, Any]:
         }
     except Exception as e:
         logger.error(f"Error getting statistics (duckdb): {e}")
-        raise 
\ No newline at end of file
+        raise 
+
+def invalidate_caches() -> None:
+    """Drop the cached schema checks; called when a new database file is picked up."""
+    _has_search_columns.cache_clear()
+    _has_brand_stats.cache_clear()
+
+
+on_database_reload(invalidate_caches)
@@ -1,17 +1,33 @@
 #!/usr/bin/env python3
-import pandas as pd
+import duckdb
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 csv_files = [f for f in os.listdir('/code/data/raw') if f.endswith('.csv')]
 print('Checking first few CSV files:')
 
-for i, csv_file in enumerate(csv_files[:3]):
-    print(f'File {i+1}: {csv_file}')
-    try:
-        df = pd.read_csv(f'/code/data/raw/{csv_file}', sep=';', encoding='latin-1', nrows=3)
-        print('nom_modele:', df['nom_modele'].tolist())
-        print('nom_metteur_sur_le_marche:', df['nom_metteur_sur_le_marche'].tolist())
-        print('---')
-    except Exception as e:
-        print(f'Error reading {csv_file}: {e}')
-        print('---')
+
+def read_head(csv_file):
+    # Only the two columns are materialized, and the sniffer stops after the sample;
+    # one connection per thread, DuckDB's reader runs without the GIL
+    with duckdb.connect() as conn:
+        return conn.execute(
+            "SELECT nom_modele, nom_metteur_sur_le_marche "
+            "FROM read_csv(?, sep=';', encoding='latin-1', header=true, sample_size=3) LIMIT 3",
+            [f'/code/data/raw/{csv_file}'],
+        ).fetchall()
+
+
+# Files are read concurrently; results are printed in file order
+with ThreadPoolExecutor(max_workers=8) as pool:
+    futures = [(f, pool.submit(read_head, f)) for f in csv_files[:3]]
+    for i, (csv_file, future) in enumerate(futures):
+        print(f'File {i+1}: {csv_file}')
+        try:
+            rows = future.result()
+            print('nom_modele:', [r[0] for r in rows])
+            print('nom_metteur_sur_le_marche:', [r[1] for r in rows])
+            print('---')
+        except Exception as e:
+            print(f'Error reading {csv_file}: {e}')
+            print('---')
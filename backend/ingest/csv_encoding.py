@@ -0,0 +1,47 @@
+"""
+Character-encoding detection for the data.gouv.fr CSV exports.
+
+The files come either as UTF-8 (with or without BOM) or as a Windows/Latin-1
+export; deciding from a sample lets callers parse each file exactly once.
+"""
+
+import codecs
+import re
+
+# Bytes inspected when guessing the encoding
+SAMPLE_SIZE = 64 * 1024
+
+_BOMS = (
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+)
+
+# 0x80-0x9F are C1 control codes in Latin-1, which text never contains, but
+# punctuation in Windows-1252 (’ “ ” – € œ ...); five of them have no cp1252 mapping
+_C1_BYTES = re.compile(rb"[\x80-\x9f]")
+_CP1252_UNDEFINED = re.compile(rb"[\x81\x8d\x8f\x90\x9d]")
+
+
+def detect_encoding(sample: bytes) -> str:
+    """Return the encoding to read a CSV with, judged from its first bytes."""
+    for bom, encoding in _BOMS:
+        if sample.startswith(bom):
+            return encoding
+    try:
+        # Incremental decode so a multi-byte character cut at the end of the
+        # sample doesn't count as invalid
+        codecs.getincrementaldecoder("utf-8")().decode(sample, final=False)
+        return "utf-8"
+    except UnicodeDecodeError:
+        pass
+    # Accented Latin-1 text is almost never valid UTF-8
+    if _C1_BYTES.search(sample) and not _CP1252_UNDEFINED.search(sample):
+        return "cp1252"
+    # latin-1 decodes any byte
+    return "latin-1"
+
+
+def detect_file_encoding(path: str) -> str:
+    with open(path, "rb") as f:
+        return detect_encoding(f.read(SAMPLE_SIZE))
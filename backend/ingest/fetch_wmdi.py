@@ -7,14 +7,23 @@ Author: Alexis GENDRONNEAU (June 2025, forward‑looking prototype)
 """
 
 from __future__ import annotations
+import functools
+import hashlib
 import io
-import json
 import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import duckdb
+import httpx
 import numpy as np
-import requests
+import orjson
 import pandas as pd
 from typing import List, Dict, Any
 
+from ingest.csv_encoding import SAMPLE_SIZE, detect_encoding
+
 from langchain_openai import ChatOpenAI
 from langchain_core.messages import SystemMessage
 from langchain.agents import AgentExecutor, create_react_agent
@@ -23,17 +32,14 @@ from langchain_experimental.tools.python.tool import PythonREPLTool
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.messages import AIMessage, HumanMessage
 
-class NpEncoder(json.JSONEncoder):
-    """ Special json encoder for numpy types """
-    def default(self, obj):
-        if isinstance(obj, np.integer):
-            return int(obj)
-        elif isinstance(obj, np.floating):
-            return float(obj)
-        elif isinstance(obj, np.ndarray):
-            return obj.tolist()
-        else:
-            return super(NpEncoder, self).default(obj)
+def _to_json(obj: Any) -> str:
+    """ Indented JSON for the agent tools; orjson encodes numpy scalars/arrays natively,
+    anything else it doesn't know (Timestamp, Decimal, set...) is written as str() """
+    return orjson.dumps(
+        obj,
+        default=str,
+        option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS,
+    ).decode()
 
 # -----------------------------------------------------------------------------
 # 1. Utility helpers for data.gouv.fr datasets
@@ -41,12 +47,85 @@ class NpEncoder(json.JSONEncoder):
 
 DGOUV_BASE_V1 = "https://www.data.gouv.fr/api/2"
 
+# One pooled client for every data.gouv.fr call: keep-alive and HTTP/2 save a
+# TCP+TLS handshake per request. httpx.Client is safe to share across threads,
+# and asks for gzip/deflate transfer compression by default. The transport
+# retries failed connection attempts; _get() retries gateway errors.
+_client = httpx.Client(
+    transport=httpx.HTTPTransport(
+        http2=True,
+        retries=3,
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=20),
+    ),
+    timeout=30,
+    follow_redirects=True,
+)
+RETRY_STATUSES = {502, 503, 504}
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.3
+# Concurrent per-dataset resource listings
+FETCH_WORKERS = 8
+
+
+def _get(url: str, **kwargs) -> httpx.Response:
+    """GET through the shared client, retrying 502/503/504 with exponential backoff."""
+    for attempt in range(MAX_RETRIES + 1):
+        resp = _client.get(url, **kwargs)
+        if resp.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+            return resp
+        time.sleep(RETRY_BACKOFF * 2 ** attempt)
+
+
+# Catalog responses (dataset search, resource listings) kept with their ETag /
+# Last-Modified, so an unchanged catalog is answered by a 304 without a body
+HTTP_CACHE_DIR = os.environ.get(
+    "WMDI_HTTP_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "http_cache"),
+)
+
+
+def _get_json(url: str) -> Any:
+    """GET a JSON document, revalidating a cached copy with a conditional request."""
+    path = os.path.join(HTTP_CACHE_DIR, hashlib.sha1(url.encode()).hexdigest() + ".json")
+    try:
+        with open(path, "rb") as f:
+            cached = orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError):
+        cached = None
+
+    headers = {}
+    if cached:
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+    resp = _get(url, headers=headers)
+    if resp.status_code == 304 and cached:
+        return cached["body"]
+    resp.raise_for_status()
+    body = resp.json()
+
+    etag = resp.headers.get("ETag")
+    last_modified = resp.headers.get("Last-Modified")
+    if etag or last_modified:
+        try:
+            os.makedirs(HTTP_CACHE_DIR, exist_ok=True)
+            # Written then renamed, so concurrent fetches never read a partial file
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(orjson.dumps({"etag": etag, "last_modified": last_modified, "body": body}))
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"Could not cache {url}: {e}")
+    return body
+
+
 def get_dataset_metadata(dataset_id: str) -> Dict[str, Any]:
     """
     Return the metadata JSON for a given data.gouv.fr dataset.
     """
     url = f"{DGOUV_BASE_V1}/datasets/{dataset_id}"
-    resp = requests.get(url, timeout=30)
+    resp = _get(url)
     resp.raise_for_status()
     return resp.json()
 
@@ -63,7 +142,7 @@ def get_resource_download_url(dataset_id: str, format_priority: List[str] = ["cs
     # Handle API v2 paginated resources where we must follow a link.
     if isinstance(resources_obj, dict) and "href" in resources_obj:
         resources_url = resources_obj["href"]
-        resp = requests.get(resources_url, timeout=30)
+        resp = _get(resources_url)
         resp.raise_for_status()
         resources_data = resp.json()
         resource_list = resources_data.get("data", [])
@@ -81,6 +160,36 @@ def get_resource_download_url(dataset_id: str, format_priority: List[str] = ["cs
     raise ValueError(f"No resource with format in {format_priority} found.")
 
 
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+
+def _stream_to_file(url: str, f) -> int:
+    """Stream the body of url into the open binary file f, one chunk in memory at a time;
+    returns the number of bytes written."""
+    with _client.stream("GET", url, timeout=60) as resp:
+        resp.raise_for_status()
+        size = resp.headers.get("Content-Length")
+        if size and hasattr(os, "posix_fallocate"):
+            # Reserve the blocks up front; truncated below if the decoded body differs
+            os.posix_fallocate(f.fileno(), 0, int(size))
+        for chunk in resp.iter_bytes(DOWNLOAD_CHUNK_SIZE):
+            f.write(chunk)
+        f.truncate()
+        return f.tell()
+
+
+def _download_to_tempfile(url: str, suffix: str = "") -> str:
+    """Stream url to a named temporary file and return its path (caller removes it)."""
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as f:
+        try:
+            _stream_to_file(url, f)
+        except Exception:
+            f.close()
+            os.unlink(f.name)
+            raise
+        return f.name
+
+
 def load_dataset_as_dataframe(dataset_id: str) -> pd.DataFrame:
     """
     Download (stream) the first CSV resource found for the dataset
@@ -88,8 +197,15 @@ def load_dataset_as_dataframe(dataset_id: str) -> pd.DataFrame:
     """
     url = get_resource_download_url(dataset_id)
     if url.endswith(".csv"):
-        return pd.read_csv(url)
-    data = requests.get(url, timeout=30).json()
+        # DuckDB sniffs the dialect and parses the file in parallel, well ahead of
+        # pandas' single-threaded parser; the download goes to disk, not memory
+        path = _download_to_tempfile(url, suffix=".csv")
+        try:
+            with duckdb.connect() as conn:
+                return conn.read_csv(path).df()
+        finally:
+            os.unlink(path)
+    data = _get(url).json()
     return pd.json_normalize(data)
 
 def fetch_all_datasets(limit: int = 100) -> list[dict]:
@@ -106,9 +222,7 @@ def fetch_all_datasets(limit: int = 100) -> list[dict]:
     
     while len(datasets) < limit:
         url = f"{DGOUV_BASE_V1}/datasets/?q={search_query}&page={page}&page_size={page_size}"
-        resp = requests.get(url, timeout=30)
-        resp.raise_for_status()
-        data = resp.json()
+        data = _get_json(url)
         page_datasets = data.get("data", [])
         if not page_datasets:
             break
@@ -124,33 +238,30 @@ def fetch_washing_machine_datasets(limit: int = 100) -> list[dict]:
     Fetch all washing machine durability index datasets and their resources.
     Returns a list of datasets with their associated resources.
     """
-    datasets = fetch_all_datasets(limit)
-    enriched_datasets = []
-    
-    for dataset in datasets:
-        dataset_id = dataset.get("id")
-        if not dataset_id:
-            continue
-            
-        try:
-            # Get resources for this dataset
-            resources_url = f"{DGOUV_BASE_V1}/datasets/{dataset_id}/resources/?page=1&page_size=50"
-            resp = requests.get(resources_url, timeout=30)
-            resp.raise_for_status()
-            resources_data = resp.json()
-            resources = resources_data.get("data", [])
-            
-            # Filter for CSV resources (the main data format for these datasets)
-            csv_resources = [r for r in resources if r.get("format", "").lower() == "csv"]
-            
-            dataset["resources"] = csv_resources
-            enriched_datasets.append(dataset)
-            
-        except Exception as e:
-            print(f"Error fetching resources for dataset {dataset_id}: {e}")
-            continue
-    
-    return enriched_datasets
+    datasets = [d for d in fetch_all_datasets(limit) if d.get("id")]
+    # The listings are independent and latency-bound, so fetch them concurrently;
+    # map() keeps the original dataset order
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as pool:
+        results = pool.map(_attach_csv_resources, datasets)
+        return [dataset for dataset in results if dataset is not None]
+
+
+def _attach_csv_resources(dataset: dict) -> dict | None:
+    """Set dataset["resources"] to its CSV resources; None if the listing failed."""
+    dataset_id = dataset["id"]
+    try:
+        # Get resources for this dataset
+        resources_url = f"{DGOUV_BASE_V1}/datasets/{dataset_id}/resources/?page=1&page_size=50"
+        resources_data = _get_json(resources_url)
+        resources = resources_data.get("data", [])
+
+        # Filter for CSV resources (the main data format for these datasets)
+        dataset["resources"] = [r for r in resources if r.get("format", "").lower() == "csv"]
+        return dataset
+
+    except Exception as e:
+        print(f"Error fetching resources for dataset {dataset_id}: {e}")
+        return None
 
 
 def load_washing_machine_data(dataset_id: str, resource_id: str = None) -> pd.DataFrame:
@@ -162,7 +273,7 @@ def load_washing_machine_data(dataset_id: str, resource_id: str = None) -> pd.Da
         if resource_id:
             # Load specific resource
             resource_url = f"{DGOUV_BASE_V1}/resources/{resource_id}/"
-            resp = requests.get(resource_url, timeout=30)
+            resp = _get(resource_url)
             resp.raise_for_status()
             resource_data = resp.json()
             url = resource_data.get("url")
@@ -171,15 +282,17 @@ def load_washing_machine_data(dataset_id: str, resource_id: str = None) -> pd.Da
             url = get_resource_download_url(dataset_id, format_priority=["csv"])
         
         if url and url.endswith(".csv"):
+            # Download once, pick the encoding from the first bytes, parse once
+            resp = _get(url, timeout=60)
+            resp.raise_for_status()
+            raw = resp.content
+            encoding = detect_encoding(raw[:SAMPLE_SIZE])
             # Handle semicolon-separated CSV files (common in French datasets)
-            # Try different encodings for French text
-            for encoding in ['latin-1', 'iso-8859-1', 'cp1252', 'utf-8']:
-                try:
-                    return pd.read_csv(url, sep=';', encoding=encoding)
-                except UnicodeDecodeError:
-                    continue
-            # If all encodings fail, try with error handling
-            return pd.read_csv(url, sep=';', encoding='latin-1', errors='replace')
+            try:
+                return pd.read_csv(io.BytesIO(raw), sep=';', encoding=encoding)
+            except UnicodeDecodeError:
+                # Non-UTF-8 bytes past the sample: latin-1 reads any byte
+                return pd.read_csv(io.BytesIO(raw), sep=';', encoding='latin-1')
         else:
             raise ValueError(f"No valid CSV resource found for dataset {dataset_id}")
             
@@ -220,6 +333,65 @@ def get_washing_machine_datasets_summary() -> dict:
     return summary
 
 
+def _download_one(dataset: dict, output_dir: str) -> tuple[str, dict] | None:
+    """
+    Download the first CSV resource of one dataset into output_dir.
+    Returns ("downloaded" | "failed", summary entry), or None if the dataset has no ID.
+    """
+    dataset_id = dataset.get("id")
+    dataset_title = dataset.get("title", "Unknown")
+    
+    if not dataset_id:
+        print(f"Skipping dataset without ID: {dataset_title}")
+        return None
+        
+    print(f"\nProcessing dataset: {dataset_title} (ID: {dataset_id})")
+    
+    try:
+        # Get the download URL for the first CSV resource
+        download_url = get_resource_download_url(dataset_id, format_priority=["csv"])
+        
+        # Create filename (sanitize title for filesystem)
+        safe_title = "".join(c for c in dataset_title if c.isalnum() or c in (' ', '-', '_')).rstrip()
+        safe_title = safe_title.replace(' ', '_')[:50]  # Limit length
+        filename = f"{dataset_id}_{safe_title}.csv"
+        filepath = os.path.join(output_dir, filename)
+        
+        print(f"  Downloading from: {download_url}")
+        print(f"  Saving to: {filepath}")
+        
+        # Stream the file to disk instead of holding the whole body in memory
+        try:
+            with open(filepath, 'wb') as f:
+                size = _stream_to_file(download_url, f)
+        except Exception:
+            # Don't leave a partial file for the loader to pick up
+            os.remove(filepath)
+            raise
+        
+        # Verify something was saved; the size comes from the write, not a stat
+        if size > 0:
+            print(f"  ✓ Successfully downloaded ({size} bytes)")
+            return "downloaded", {
+                "id": dataset_id,
+                "title": dataset_title,
+                "filepath": filepath,
+                "size_bytes": size,
+                "url": download_url
+            }
+        else:
+            raise Exception("File was not saved properly")
+            
+    except Exception as e:
+        error_msg = f"Failed to download dataset {dataset_id}: {str(e)}"
+        print(f"  ✗ {error_msg}")
+        return "failed", {
+            "id": dataset_id,
+            "title": dataset_title,
+            "error": str(e)
+        }
+
+
 def download_all_washing_machine_data_raw(output_dir: str = "data/raw") -> dict:
     """
     Download all washing machine durability datasets as raw CSV files.
@@ -244,58 +416,15 @@ def download_all_washing_machine_data_raw(output_dir: str = "data/raw") -> dict:
     
     print(f"Found {len(datasets)} washing machine datasets to download...")
     
-    for dataset in datasets:
-        dataset_id = dataset.get("id")
-        dataset_title = dataset.get("title", "Unknown")
-        
-        if not dataset_id:
-            print(f"Skipping dataset without ID: {dataset_title}")
+    # Downloads are independent and network-bound: run them on the pool, then
+    # collect the outcomes in dataset order
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as pool:
+        outcomes = list(pool.map(lambda d: _download_one(d, output_dir), datasets))
+    for outcome in outcomes:
+        if outcome is None:
             continue
-            
-        print(f"\nProcessing dataset: {dataset_title} (ID: {dataset_id})")
-        
-        try:
-            # Get the download URL for the first CSV resource
-            download_url = get_resource_download_url(dataset_id, format_priority=["csv"])
-            
-            # Create filename (sanitize title for filesystem)
-            safe_title = "".join(c for c in dataset_title if c.isalnum() or c in (' ', '-', '_')).rstrip()
-            safe_title = safe_title.replace(' ', '_')[:50]  # Limit length
-            filename = f"{dataset_id}_{safe_title}.csv"
-            filepath = os.path.join(output_dir, filename)
-            
-            print(f"  Downloading from: {download_url}")
-            print(f"  Saving to: {filepath}")
-            
-            # Download the file
-            response = requests.get(download_url, timeout=60)
-            response.raise_for_status()
-            
-            # Save to file
-            with open(filepath, 'wb') as f:
-                f.write(response.content)
-            
-            # Verify the file was saved and is readable
-            if os.path.exists(filepath) and os.path.getsize(filepath) > 0:
-                download_summary["downloaded"].append({
-                    "id": dataset_id,
-                    "title": dataset_title,
-                    "filepath": filepath,
-                    "size_bytes": os.path.getsize(filepath),
-                    "url": download_url
-                })
-                print(f"  ✓ Successfully downloaded ({os.path.getsize(filepath)} bytes)")
-            else:
-                raise Exception("File was not saved properly")
-                
-        except Exception as e:
-            error_msg = f"Failed to download dataset {dataset_id}: {str(e)}"
-            print(f"  ✗ {error_msg}")
-            download_summary["failed"].append({
-                "id": dataset_id,
-                "title": dataset_title,
-                "error": str(e)
-            })
+        status, entry = outcome
+        download_summary[status].append(entry)
     
     # Print final summary
     print(f"\n{'='*50}")
@@ -321,39 +450,43 @@ def quick_insights(df: pd.DataFrame) -> Dict[str, Any]:
     Return a lightweight JSON with common profiling statistics
     (null counts, distinct counts, sample rows, numeric distributions).
     """
-    # Only describe numeric columns if they exist.
+    # Only describe numeric columns with some spread: all-NaN columns are left out
+    # and constant ones only report their value, sparing describe()'s percentile sorts
     numeric_df = df.select_dtypes(include=np.number)
+    numeric_description = {}
+    constant_numeric = {}
     if not numeric_df.empty:
         try:
-            numeric_description = numeric_df.describe().to_dict()
+            numeric_df = numeric_df.loc[:, numeric_df.notna().any()]
+            mins, maxs = numeric_df.min(), numeric_df.max()
+            constant = mins == maxs
+            constant_numeric = mins[constant].to_dict()
+            varying_df = numeric_df.loc[:, ~constant]
+            if not varying_df.empty:
+                numeric_description = varying_df.describe().to_dict()
         except Exception:
             numeric_description = {}
-    else:
-        numeric_description = {}
 
-    # Convert DataFrame head to records, handling any non-serializable objects
+    # Convert DataFrame head to records; numbers and booleans serialise as-is, so
+    # only the other columns (object, datetime, ...) are stringified, per column
     try:
-        head_records = df.head().to_dict(orient="records")
-        # Convert any non-serializable objects to strings
-        for record in head_records:
-            for key, value in record.items():
-                if not isinstance(value, (str, int, float, bool, type(None))):
-                    record[key] = str(value)
+        head = df.head().copy()
+        text_cols = head.select_dtypes(exclude=[np.number, "bool"]).columns
+        if len(text_cols):
+            text = head[text_cols]
+            head[text_cols] = text.astype(str).where(text.notna(), None)
+        head_records = head.to_dict(orient="records")
     except Exception:
         head_records = []
 
-    # Convert null counts and distinct counts to serializable format
+    # Already integer Series; the JSON encoder takes non-string column names
     try:
         null_counts = df.isna().sum().to_dict()
-        # Convert any non-serializable keys/values to strings
-        null_counts = {str(k): int(v) for k, v in null_counts.items()}
     except Exception:
         null_counts = {}
 
     try:
         distinct_counts = df.nunique(dropna=False).to_dict()
-        # Convert any non-serializable keys/values to strings
-        distinct_counts = {str(k): int(v) for k, v in distinct_counts.items()}
     except Exception:
         distinct_counts = {}
 
@@ -362,6 +495,7 @@ def quick_insights(df: pd.DataFrame) -> Dict[str, Any]:
         "columns": [str(col) for col in df.columns],  # Ensure all column names are strings
         "head": head_records,
         "describe_numeric": numeric_description,
+        "constant_numeric": constant_numeric,
         "null_counts": null_counts,
         "distinct_counts": distinct_counts,
     }
@@ -384,7 +518,7 @@ def _load_dataset(dataset_id: str) -> str:
 def _load_washing_machine_datasets(_: str) -> str:
     """Fetch and return a summary of all available washing machine durability datasets."""
     summary = get_washing_machine_datasets_summary()
-    return json.dumps(summary, indent=2, ensure_ascii=False, cls=NpEncoder)
+    return _to_json(summary)
 
 
 def _summarise_dataset(_: str) -> str:
@@ -392,7 +526,7 @@ def _summarise_dataset(_: str) -> str:
     if df is None:
         return "No dataset is currently loaded."
     insights = quick_insights(df)
-    return json.dumps(insights, indent=2, ensure_ascii=False, cls=NpEncoder)
+    return _to_json(insights)
 
 _memory: Dict[str, Any] = {}
 
@@ -420,30 +554,34 @@ tools = [
 # 4. Build the agent
 # -----------------------------------------------------------------------------
 
+# Construct the ReAct chat prompt manually for robustness.
+SYSTEM_PROMPT = (
+    "You are a data‑analysis assistant.\n"
+    "When asked analytical questions, first check the chat history to see if the required data or context "
+    "is already available. Only ask the user for information if you cannot find it in the history or tools.\n"
+    "You have access to the following tools:\n\n"
+    "{tools}\n\n"
+    "Use the following format:\n\n"
+    "Question: the input question you must answer\n"
+    "Thought: you should always think about what to do\n"
+    "Action: the action to take, should be one of [{tool_names}]\n"
+    "Action Input: the input to the action\n"
+    "Observation: the result of the action\n"
+    "... (this Thought/Action/Action Input/Observation can repeat N times)\n"
+    "Thought: I now know the final answer\n"
+    "Final Answer: the final answer to the original input question"
+)
+
+
+# The executor holds no per-conversation state (history is passed to invoke), so one
+# per temperature is reused instead of rebuilding the client, prompt and tool schemas
+@functools.lru_cache(maxsize=4)
 def build_agent(llm_temperature: float = 0.0):
     llm = ChatOpenAI(temperature=llm_temperature, model="gpt-4o-mini")
-    
-    # Construct the ReAct chat prompt manually for robustness.
-    system_prompt = (
-        "You are a data‑analysis assistant.\n"
-        "When asked analytical questions, first check the chat history to see if the required data or context "
-        "is already available. Only ask the user for information if you cannot find it in the history or tools.\n"
-        "You have access to the following tools:\n\n"
-        "{tools}\n\n"
-        "Use the following format:\n\n"
-        "Question: the input question you must answer\n"
-        "Thought: you should always think about what to do\n"
-        "Action: the action to take, should be one of [{tool_names}]\n"
-        "Action Input: the input to the action\n"
-        "Observation: the result of the action\n"
-        "... (this Thought/Action/Action Input/Observation can repeat N times)\n"
-        "Thought: I now know the final answer\n"
-        "Final Answer: the final answer to the original input question"
-    )
 
     prompt = ChatPromptTemplate.from_messages(
         [
-            ("system", system_prompt),
+            ("system", SYSTEM_PROMPT),
             MessagesPlaceholder(variable_name="chat_history"),
             ("human", "{input}"),
             ("ai", "{agent_scratchpad}"),
@@ -6,15 +6,27 @@ This script reads CSV files from a data directory and loads them into
  the washing_machines table in DuckDB.
 """
 
+import csv
 import os
+import re
 import sys
 import pandas as pd
+import pyarrow as pa
 import duckdb
 from typing import List
 import logging
+from itertools import groupby
 from pathlib import Path
 
-from app.duckdb_utils import get_connection
+from ingest.csv_encoding import SAMPLE_SIZE, detect_encoding
+from app.duckdb_utils import (
+    cluster_by_default_sort,
+    drop_indexes,
+    refresh_brand_stats,
+    refresh_search_columns,
+    restore_indexes,
+    write_connection,
+)
 
 # Setup logging
 logging.basicConfig(
@@ -26,10 +38,11 @@ logger = logging.getLogger(__name__)
 
 # ---------------- Path resolution ---------------- #
 
+_BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+
 def _candidate_dirs() -> list[Path]:
     cwd = Path(os.getcwd())
-    script_dir = Path(__file__).resolve().parent
-    backend_dir = script_dir.parent
 
     candidates: list[Path] = []
 
@@ -40,7 +53,7 @@ def _candidate_dirs() -> list[Path]:
 
     candidates.append(cwd / "backend" / "data" / "raw")
     candidates.append(cwd / "data" / "raw")
-    candidates.append(backend_dir / "data" / "raw")
+    candidates.append(_BACKEND_DIR / "data" / "raw")
     candidates.append(cwd / "data")
 
     out: list[Path] = []
@@ -54,54 +67,81 @@ def _candidate_dirs() -> list[Path]:
 
 
 def get_csv_files() -> List[str]:
-    files: list[str] = []
+    """CSV files of the first candidate directory (in priority order) that has any."""
     checked: list[str] = []
     for d in _candidate_dirs():
         checked.append(str(d))
-        if d.exists() and d.is_dir():
-            for file in sorted(d.glob("*.csv")):
-                files.append(str(file))
-    if not files:
-        logger.error("No CSV files found. Checked: %s", ", ".join(checked))
-    else:
-        logger.info(
-            "Found %d CSV files in: %s",
-            len(files),
-            ", ".join(sorted({str(Path(f).parent) for f in files})),
-        )
-    return files
+        try:
+            with os.scandir(d) as it:
+                files = [
+                    entry.path for entry in it
+                    if entry.name.endswith(".csv") and entry.is_file(follow_symlinks=False)
+                ]
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        if files:
+            files.sort()
+            logger.info("Found %d CSV files in: %s", len(files), d)
+            return files
+    logger.error("No CSV files found. Checked: %s", ", ".join(checked))
+    return []
 
 
 # ---------------- CSV helpers ---------------- #
 
+# Lines of the sample given to csv.Sniffer; its cost grows with the text
+SNIFF_LINES = 20
+
+
+def _sniff_separator(text: str) -> str:
+    lines = text.splitlines()[:SNIFF_LINES]
+    try:
+        # Sees through delimiters inside quoted fields, unlike a plain membership test
+        return csv.Sniffer().sniff("\n".join(lines), delimiters=";,").delimiter
+    except csv.Error:
+        first_line = lines[0] if lines else ""
+        return ';' if ';' in first_line else ','
+
+
+def sniff_csv(file_path: str) -> tuple[str, str]:
+    """(separator, encoding) of a CSV file, both judged from one read of its first bytes."""
+    with open(file_path, 'rb') as f:
+        sample = f.read(SAMPLE_SIZE)
+    encoding = detect_encoding(sample)
+    return _sniff_separator(sample.decode(encoding, errors='replace')), encoding
+
+
 def detect_separator(file_path: str) -> str:
-    with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-        first_line = f.readline().strip()
-        if ';' in first_line:
-            return ';'
-        elif ',' in first_line:
-            return ','
-        else:
-            return ','
+    return sniff_csv(file_path)[0]
 
 
 def clean_column_name(col: str) -> str:
     return col.replace('.', '_')
 
 
+def _read_csv(file_path: str, separator: str, encoding: str) -> pd.DataFrame:
+    try:
+        # Multi-threaded Arrow parser; strings stay Arrow buffers instead of Python objects
+        return pd.read_csv(file_path, sep=separator, encoding=encoding,
+                           engine="pyarrow", dtype_backend="pyarrow")
+    except ValueError as e:
+        # A file the Arrow parser rejects (pa.ArrowInvalid is a ValueError)
+        logger.info(f"PyArrow CSV engine rejected {file_path} ({e}), using the C engine")
+        # Parse straight from a mapping of the file rather than a copied read buffer
+        return pd.read_csv(file_path, sep=separator, encoding=encoding, low_memory=False,
+                           memory_map=True)
+
+
 def load_csv_to_dataframe(file_path: str) -> pd.DataFrame:
-    separator = detect_separator(file_path)
-    logger.info(f"Loading {file_path} with separator '{separator}'")
-    encodings = ['utf-8', 'latin-1', 'iso-8859-1', 'cp1252']
-    for encoding in encodings:
-        try:
-            df = pd.read_csv(file_path, sep=separator, encoding=encoding, low_memory=False)
-            logger.info(f"Successfully loaded with encoding {encoding}")
-            return df
-        except Exception as e:
-            logger.warning(f"Failed to load with encoding {encoding}: {e}")
-            continue
-    raise Exception(f"Could not load {file_path} with any encoding")
+    # Decided from the first 64 KB, so the file is parsed once
+    separator, encoding = sniff_csv(file_path)
+    logger.info(f"Loading {file_path} with separator '{separator}' and encoding {encoding}")
+    try:
+        return _read_csv(file_path, separator, encoding)
+    except UnicodeDecodeError as e:
+        # Non-UTF-8 bytes past the sample: latin-1 reads any byte
+        logger.warning(f"Failed to load with encoding {encoding}: {e}")
+        return _read_csv(file_path, separator, 'latin-1')
 
 
 # ---------------- Schema helpers ---------------- #
@@ -110,18 +150,31 @@ NUMERIC_COLUMNS_PREFIXES = ("note_")
 NUMERIC_COLUMNS_EXACT = {"note_id", "note_reparabilite", "note_fiabilite"}
 INTEGER_HINTS = ("delai_jours", "nb_annees")
 DATE_COLUMNS = {"date_calcul"}
+_INTEGER_HINT_RE = re.compile("|".join(map(re.escape, INTEGER_HINTS)))
 
 
-def prepare_dataframe(df: pd.DataFrame) -> pd.DataFrame:
-    df.columns = [clean_column_name(col) for col in df.columns]
+def _is_numeric_column(col: str) -> bool:
+    return (
+        col in NUMERIC_COLUMNS_EXACT
+        or col.startswith(NUMERIC_COLUMNS_PREFIXES)
+        or _INTEGER_HINT_RE.search(col) is not None
+    )
 
-    for col in df.columns:
-        if col in DATE_COLUMNS:
-            df[col] = pd.to_datetime(df[col], errors='coerce').dt.date
-        elif col in NUMERIC_COLUMNS_EXACT or col.startswith(NUMERIC_COLUMNS_PREFIXES) or any(h in col for h in INTEGER_HINTS):
-            # Treat all numeric/integer-like as float to be permissive
-            df[col] = pd.to_numeric(df[col], errors='coerce')
-        # else leave as object/string
+
+def prepare_dataframe(df: pd.DataFrame) -> pd.DataFrame:
+    # Same as clean_column_name, on the whole Index at once
+    df.columns = df.columns.str.replace('.', '_', regex=False)
+
+    date_cols = [col for col in df.columns if col in DATE_COLUMNS]
+    numeric_cols = [col for col in df.columns if col not in DATE_COLUMNS and _is_numeric_column(col)]
+    if date_cols:
+        # Kept as datetime64; DuckDB casts to DATE on insert, which is far cheaper
+        # than building a Python date object per cell with .dt.date
+        df[date_cols] = df[date_cols].apply(pd.to_datetime, errors='coerce')
+    if numeric_cols:
+        # Treat all numeric/integer-like as float to be permissive
+        df[numeric_cols] = df[numeric_cols].apply(pd.to_numeric, errors='coerce')
+    # Other columns are left as strings
     return df
 
 
@@ -129,116 +182,268 @@ def infer_duckdb_type(col: str, series: pd.Series) -> str:
     if col in DATE_COLUMNS:
         return "DATE"
     # All numeric and integer-like become DOUBLE to avoid cast errors
-    if col in NUMERIC_COLUMNS_EXACT or col.startswith(NUMERIC_COLUMNS_PREFIXES) or any(h in col for h in INTEGER_HINTS):
+    if _is_numeric_column(col):
         return "DOUBLE"
     return "VARCHAR"
 
 
-def create_table_with_schema(conn, df: pd.DataFrame):
-    cols_sql = ["id BIGINT"]
-    for col in df.columns:
-        dtype = infer_duckdb_type(col, df[col])
-        cols_sql.append(f"{col} {dtype}")
-    ddl = "CREATE TABLE washing_machines (" + ", ".join(cols_sql) + ")"
-    conn.execute(ddl)
+# Columns of the data.gouv.fr exports (after clean_column_name), created up front
+# with their final types so no load has to retype a column; columns new in the
+# data are still added as they appear
+KNOWN_COLUMNS: list[tuple[str, str]] = [
+    (col, infer_duckdb_type(col, None))
+    for col in (
+        "id_unique",
+        "nom_modele",
+        "nom_metteur_sur_le_marche",
+        "categorie_produit",
+        "date_calcul",
+        "note_reparabilite",
+        "note_fiabilite",
+        "note_id",
+        "note_A_c1", "note_A_c2", "note_A_c3", "note_A_c4",
+        "note_B_c1", "note_B_c2", "note_B_c3",
+        "url_tableau_detail_notation",
+        "accessibilite_compteur_usage",
+        "lien_documentation_professionnels",
+        "lien_documentation_particuliers",
+        "nom_piece_1_liste_2", "nom_piece_2_liste_2", "nom_piece_3_liste_2",
+        "nom_piece_4_liste_2", "nom_piece_5_liste_2",
+        "etape_demontage_piece_1_liste_2", "etape_demontage_piece_2_liste_2",
+        "etape_demontage_piece_3_liste_2", "etape_demontage_piece_4_liste_2",
+        "etape_demontage_piece_5_liste_2",
+    )
+]
+
+
+# Row IDs are drawn from this sequence at insert time, continuing after the rows
+# already in the table
+ID_SEQUENCE = "wm_id_seq"
+
+
+# Column -> DuckDB type of washing_machines, read by ensure_table and kept current
+# by add_column, so the per-file loads don't query the catalog again
+_schema_cache: dict[str, str] = {}
+
+
+def ensure_table(conn):
+    """Create washing_machines with KNOWN_COLUMNS, and its ID sequence, if they don't exist
+    yet; (re)loads the schema cache."""
+    cols_sql = ["id BIGINT"] + [f"{col} {duck_type}" for col, duck_type in KNOWN_COLUMNS]
+    conn.execute("CREATE TABLE IF NOT EXISTS washing_machines (" + ", ".join(cols_sql) + ")")
+    has_sequence = conn.execute(
+        "SELECT COUNT(*) FROM duckdb_sequences() WHERE sequence_name = ?", [ID_SEQUENCE]
+    ).fetchone()[0]
+    if not has_sequence:
+        start = conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM washing_machines").fetchone()[0]
+        conn.execute(f"CREATE SEQUENCE {ID_SEQUENCE} START {int(start)}")
+    _schema_cache.clear()
+    _schema_cache.update(
+        (name, duck_type)
+        for _, name, duck_type, *_ in conn.execute("PRAGMA table_info('washing_machines')").fetchall()
+    )
 
 
-def ensure_id_column(conn):
-    has_id = conn.execute(
-        "SELECT COUNT(*) FROM pragma_table_info('washing_machines') WHERE name='id'"
-    ).fetchone()[0]
-    if not has_id:
-        conn.execute("ALTER TABLE washing_machines ADD COLUMN id BIGINT")
-        conn.execute(
-            "UPDATE washing_machines SET id = row_number() OVER ()"
-        )
+def table_schema(conn) -> dict[str, str]:
+    if not _schema_cache:
+        ensure_table(conn)
+    return _schema_cache
 
 
-def relax_integer_columns(conn):
-    info = conn.execute("PRAGMA table_info('washing_machines')").fetchdf()
-    integer_types = {"TINYINT", "SMALLINT", "INTEGER", "BIGINT"}
-    for name, typ in zip(info['name'], info['type']):
-        if name == 'id':
-            continue
-        if typ in integer_types:
-            conn.execute(f"ALTER TABLE washing_machines ALTER COLUMN {name} TYPE DOUBLE")
+def add_column(conn, col: str, duck_type: str):
+    conn.execute(f"ALTER TABLE washing_machines ADD COLUMN {col} {duck_type}")
+    _schema_cache[col] = duck_type
+
+
+def _varchar_array(s: pd.Series) -> pa.Array:
+    try:
+        arr = pa.array(s, from_pandas=True)
+        if not pa.types.is_string(arr.type) and not pa.types.is_large_string(arr.type):
+            arr = arr.cast(pa.large_string())
+        return arr
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        # Mixed Python objects (e.g. str and int in one column); nulls are masked
+        # column-wise rather than tested cell by cell
+        return pa.array(s.astype(str).to_numpy(), mask=s.isna().to_numpy(), type=pa.large_string())
 
 
-def coerce_df_to_table_schema(conn, df: pd.DataFrame, current_id: int = 1) -> pd.DataFrame:
-    info = conn.execute("PRAGMA table_info('washing_machines')").fetchdf()
-    existing_cols = set(info['name'])
+def coerce_df_to_table_schema(conn, df: pd.DataFrame) -> tuple[pa.Table, list[str]]:
+    """Align df with the table schema (adding new columns) as an Arrow table, which
+    DuckDB scans directly instead of converting Python objects one by one."""
+    type_map = table_schema(conn)
 
     # Add missing columns with permissive types
     for col in df.columns:
-        if col not in existing_cols:
-            duck_type = infer_duckdb_type(col, df[col])
-            conn.execute(f"ALTER TABLE washing_machines ADD COLUMN {col} {duck_type}")
-            existing_cols.add(col)
-
-    # Refresh schema
-    info = conn.execute("PRAGMA table_info('washing_machines')").fetchdf()
-    type_map = dict(zip(info['name'], info['type']))
+        if col not in type_map:
+            add_column(conn, col, infer_duckdb_type(col, df[col]))
 
-    # Build aligned DataFrame
+    # Build aligned Arrow columns
     out_cols = {}
     for col, dtype in type_map.items():
-        if col == 'id':
-            # Generate sequential IDs starting from current_id
-            out_cols[col] = pd.Series(range(current_id, current_id + len(df)))
-        elif col not in df.columns:
-            out_cols[col] = pd.Series([None] * len(df))
-        else:
+        if col != 'id' and col in df.columns:
             s = df[col]
+            # Columns prepare_dataframe already converted are passed through as-is
             if dtype in ("DOUBLE", "REAL", "DECIMAL"):
-                s = pd.to_numeric(s, errors='coerce')
+                if not pd.api.types.is_numeric_dtype(s):
+                    s = pd.to_numeric(s, errors='coerce')
             elif dtype == "DATE":
-                s = pd.to_datetime(s, errors='coerce').dt.date
+                if not pd.api.types.is_datetime64_any_dtype(s):
+                    s = pd.to_datetime(s, errors='coerce')
             else:  # VARCHAR
-                s = s.where(pd.notna(s), None).astype(object)
-            out_cols[col] = s
-    ordered_cols = list(type_map.keys())
-    out = pd.DataFrame({c: out_cols.get(c, pd.Series([None] * len(df))) for c in ordered_cols})
+                out_cols[col] = _varchar_array(s)
+                continue
+            out_cols[col] = pa.array(s, from_pandas=True)
+    # Table columns absent from this file are left out of the INSERT and stay NULL
+    ordered_cols = list(out_cols)
+    out = pa.table(out_cols)
     return out, ordered_cols
 
 
 # ---------------- Write logic ---------------- #
 
-def try_insert(conn, df: pd.DataFrame, current_id: int = 1) -> bool:
-    df2, cols = coerce_df_to_table_schema(conn, df, current_id)
+def try_insert(conn, df: pd.DataFrame) -> bool:
+    df2, cols = coerce_df_to_table_schema(conn, df)
     conn.register("df", df2)
     placeholders = ", ".join(cols)
     try:
-        conn.execute(f"INSERT INTO washing_machines ({placeholders}) SELECT {placeholders} FROM df")
+        conn.execute(
+            f"INSERT INTO washing_machines (id, {placeholders}) "
+            f"SELECT nextval('{ID_SEQUENCE}'), {placeholders} FROM df"
+        )
         return True
     finally:
         conn.unregister("df")
 
 
-def append_dataframe(conn, df: pd.DataFrame, current_id: int = 1):
-    exists = conn.execute(
-        "SELECT COUNT(*) FROM information_schema.tables WHERE table_name='washing_machines'"
+def append_dataframe(conn, df: pd.DataFrame):
+    try_insert(conn, df)
+
+
+# ---------------- DuckDB native path ---------------- #
+
+# detect_encoding() result -> DuckDB read_csv encoding (BOMs are skipped natively);
+# cp1252 isn't built into DuckDB's reader, so those files go through pandas
+DUCKDB_ENCODINGS = {"utf-8": "utf-8", "utf-8-sig": "utf-8", "utf-16": "utf-16", "latin-1": "latin-1"}
+
+
+# The data.gouv.fr exports all quote the same way (RFC 4180, as pandas assumes too);
+# stating it skips DuckDB's dialect sniffing, which otherwise runs on every read
+CSV_DIALECT = "quote='\"', escape='\"'"
+
+
+def _cast_expression(raw_col: str, duck_type: str) -> str:
+    """SQL converting a text CSV column to the table type; unparsable values become NULL,
+    like pd.to_numeric / pd.to_datetime with errors='coerce'."""
+    quoted = '"' + raw_col.replace('"', '""') + '"'
+    if duck_type == "VARCHAR":
+        return quoted
+    if duck_type == "DATE":
+        return f"TRY_CAST(TRY_CAST({quoted} AS TIMESTAMP) AS DATE)"
+    return f"TRY_CAST({quoted} AS {duck_type})"
+
+
+def _header_line(file_path: str) -> bytes:
+    with open(file_path, 'rb') as f:
+        return f.readline()
+
+
+def insert_csv_with_duckdb(conn, file_paths: List[str]) -> int:
+    """Parse file_paths (all with the same sniff_csv result) with DuckDB's CSV reader and insert
+    them; returns the row count.
+
+    Same schema rules as the pandas path (clean_column_name, infer_duckdb_type,
+    new columns added), but the files are read, converted and inserted in one
+    statement; columns are matched by name across files.
+    """
+    separator, encoding = sniff_csv(file_paths[0])
+    if encoding not in DUCKDB_ENCODINGS:
+        raise ValueError(f"DuckDB's CSV reader doesn't support {encoding}")
+    encoding = DUCKDB_ENCODINGS[encoding]
+    # Exports of one schema share their header byte for byte: then the first file
+    # describes them all, and DuckDB needn't sniff and reconcile every file's columns
+    same_header = len({_header_line(path) for path in file_paths}) == 1
+    source = (
+        "read_csv(?, delim=?, encoding=?, header=true, all_varchar=true, "
+        f"union_by_name={'false' if same_header else 'true'}, {CSV_DIALECT})"
+    )
+    source_params = [file_paths, separator, encoding]
+    describe_params = [file_paths[:1] if same_header else file_paths, separator, encoding]
+    raw_cols = [r[0] for r in conn.execute(f"DESCRIBE SELECT * FROM {source}", describe_params).fetchall()]
+    columns = {clean_column_name(col): col for col in raw_cols}
+
+    type_map = table_schema(conn)
+    for col in columns:
+        if col not in type_map:
+            add_column(conn, col, infer_duckdb_type(col, None))
+
+    target = ", ".join(["id", *columns])
+    values = ", ".join(_cast_expression(raw, type_map[col]) for col, raw in columns.items())
+    return conn.execute(
+        f"INSERT INTO washing_machines ({target}) "
+        # Numbered rows keep file order, so IDs follow the files as the old
+        # row_number() IDs did instead of whichever reader thread finishes first
+        f"SELECT nextval('{ID_SEQUENCE}'), {values} "
+        f"FROM (SELECT *, row_number() OVER () AS _row FROM {source}) ORDER BY _row",
+        source_params,
     ).fetchone()[0]
-    if not exists:
-        create_table_with_schema(conn, df)
-    else:
-        ensure_id_column(conn)
 
-    # First attempt
+
+def _ingest_one(conn, path: str) -> int:
     try:
-        if try_insert(conn, df, current_id):
-            return
+        return insert_csv_with_duckdb(conn, [path])
     except Exception as e:
-        err = str(e)
-        logger.warning(f"First insert attempt failed, relaxing integer columns: {err}")
-
-    # Relax integer columns and retry once
-    relax_integer_columns(conn)
-    if not try_insert(conn, df, current_id):
-        conn.execute("SELECT 1")  # no-op for symmetry
+        # Pandas path: slower, but tolerant of files DuckDB's reader rejects
+        logger.warning(f"DuckDB CSV reader failed on {path}, using pandas: {e}")
+        df = load_csv_to_dataframe(path)
+        df = prepare_dataframe(df)
+        append_dataframe(conn, df)
+        return len(df)
 
 
 # ---------------- Main ---------------- #
 
+def load_files(conn, csv_files: List[str]) -> int:
+    """Insert csv_files into washing_machines and rebuild the derived data; returns the row count."""
+    # DuckDB already parses a batch's files in parallel; size its pool to the machine
+    # rather than the API's threads=4 (one writer process only, so no process pool)
+    conn.execute(f"PRAGMA threads={os.cpu_count() or 4}")
+    total = 0
+    ensure_table(conn)
+    # Indexes (from the migrations) would be updated row by row by every INSERT below;
+    # drop them for the load and build each once at the end
+    index_sql = drop_indexes(conn)
+
+    try:
+        # Consecutive files of the same format go in as one INSERT; if that fails,
+        # fall back to file by file so one bad file doesn't hold back the others
+        for _, group in groupby(csv_files, key=sniff_csv):
+            paths = list(group)
+            if len(paths) > 1:
+                try:
+                    inserted = insert_csv_with_duckdb(conn, paths)
+                    total += inserted
+                    logger.info(f"Inserted {inserted} rows from {len(paths)} files")
+                    continue
+                except Exception as e:
+                    logger.warning(f"Batch insert of {len(paths)} files failed, loading them one by one: {e}")
+            for path in paths:
+                try:
+                    inserted = _ingest_one(conn, path)
+                    total += inserted
+                    logger.info(f"Inserted {inserted} rows from {os.path.basename(path)}")
+                except Exception as e:
+                    logger.error(f"Failed to ingest {path}: {e}")
+                    continue
+
+        if total:
+            refresh_search_columns(conn)
+            refresh_brand_stats(conn)
+            cluster_by_default_sort(conn)
+    finally:
+        restore_indexes(conn, index_sql)
+    return total
+
+
 def main():
     logger.info("Starting washing machine data ingestion into DuckDB...")
 
@@ -246,32 +451,10 @@ def main():
     if not csv_files:
         return
 
-    conn = get_connection()
-    total = 0
-    # Compute starting ID to avoid primary key collisions if table already exists
-    try:
-        table_exists = conn.execute(
-            "SELECT COUNT(*) FROM information_schema.tables WHERE table_name='washing_machines'"
-        ).fetchone()[0]
-        if table_exists:
-            max_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM washing_machines").fetchone()[0]
-            current_id = int(max_id) + 1
-        else:
-            current_id = 1
-    except Exception:
-        current_id = 1
-    
-    for path in csv_files:
-        try:
-            df = load_csv_to_dataframe(path)
-            df = prepare_dataframe(df)
-            append_dataframe(conn, df, current_id)
-            total += len(df)
-            current_id += len(df)
-            logger.info(f"Inserted {len(df)} rows from {os.path.basename(path)}")
-        except Exception as e:
-            logger.error(f"Failed to ingest {path}: {e}")
-            continue
+    # Loads into a copy of the database that replaces the file once complete, so it
+    # runs while the API holds the file open and a failed run leaves it untouched
+    with write_connection() as conn:
+        total = load_files(conn, csv_files)
 
     logger.info(f"Ingestion completed. Total rows processed: {total}")
 
@@ -19,8 +19,8 @@ import re
 from io import BytesIO
 from PIL import Image
 
-from app.duckdb_utils import get_connection
-from app.amazon_lookup import AmazonProductLookup
+from app.duckdb_utils import write_connection
+from app.amazon_lookup import AmazonProductLookup, close_session
 import random
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
@@ -413,10 +413,31 @@ async def retailer_lookup_image(session: aiohttp.ClientSession, brand: str, mode
     return None
 
 
+# Saved image paths waiting to be written; applied LOCAL_PATH_BATCH_SIZE at a time in
+# one UPDATE instead of a statement and commit per image
+LOCAL_PATH_BATCH_SIZE = 50
+_pending_local_paths: List[Tuple[int, str]] = []
+
+
+def flush_local_image_paths(conn) -> None:
+    if not _pending_local_paths:
+        return
+    values = ", ".join("(?, ?)" for _ in _pending_local_paths)
+    params = [v for row in _pending_local_paths for v in row]
+    conn.execute(
+        f"UPDATE washing_machines AS w SET local_image_path = s.path "
+        f"FROM (VALUES {values}) AS s(id, path) WHERE w.id = s.id",
+        params,
+    )
+    conn.commit()
+    _pending_local_paths.clear()
+
+
 async def upsert_local_image_path(conn, lock: asyncio.Lock, machine_id: int, rel_path: str) -> None:
     async with lock:
-        conn.execute("UPDATE washing_machines SET local_image_path = ? WHERE id = ?", [rel_path, machine_id])
-        conn.commit()
+        _pending_local_paths.append((machine_id, rel_path))
+        if len(_pending_local_paths) >= LOCAL_PATH_BATCH_SIZE:
+            flush_local_image_paths(conn)
 
 
 def _looks_like_washing_machine_text(html: str) -> bool:
@@ -610,8 +631,16 @@ async def download_for_machine(session: aiohttp.ClientSession, db_conn, lock: as
 
 
 async def main_async(limit: int = 200, allow_lookup: bool = False, refresh_bad: bool = False, rebuild_missing: bool = False, force_update: bool = False, prefer_vendor: bool = False, prefer_retailers: bool = False):
-    # Single read-write connection for all operations
-    conn = get_connection(readonly=False)
+    # Single read-write connection for all operations, on a copy of the database that
+    # replaces the file when the run ends (the API keeps the file open, so it can't be
+    # written in place)
+    with write_connection() as conn:
+        await _download_images(conn, limit, allow_lookup, refresh_bad, rebuild_missing,
+                               force_update, prefer_vendor, prefer_retailers)
+
+
+async def _download_images(conn, limit: int, allow_lookup: bool, refresh_bad: bool, rebuild_missing: bool,
+                           force_update: bool, prefer_vendor: bool, prefer_retailers: bool):
     conn.execute("ALTER TABLE washing_machines ADD COLUMN IF NOT EXISTS local_image_path TEXT")
     conn.commit()
 
@@ -700,10 +729,10 @@ async def main_async(limit: int = 200, allow_lookup: bool = False, refresh_bad:
             tasks = [download_for_machine(session, conn, lock, m, lookup_ctx, allow_lookup, prefer_vendor, prefer_retailers) for m in machines]
             await asyncio.gather(*tasks)
         finally:
+            flush_local_image_paths(conn)
             if lookup_ctx:
                 await lookup_ctx.__aexit__(None, None, None)
-        # Keep connection open until all tasks finished; then close
-        conn.close()
+                await close_session()
 
 
 def main():
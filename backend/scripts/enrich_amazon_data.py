@@ -10,12 +10,14 @@ import os
 import logging
 from pathlib import Path
 
+import pandas as pd
+
 # Add the backend directory to the Python path
 backend_dir = Path(__file__).parent.parent
 sys.path.insert(0, str(backend_dir))
 
-from app.duckdb_utils import get_connection
-from app.amazon_lookup import AmazonProductLookup
+from app.duckdb_utils import get_connection, write_connection
+from app.amazon_lookup import AmazonProductLookup, AmazonLookupCache, close_session
 
 # Configure logging
 logging.basicConfig(
@@ -77,41 +79,50 @@ async def get_machines_without_amazon_data(limit: int = 100) -> list:
         logger.error(f"Error getting machines: {e}")
         return []
 
-async def update_machine_amazon_data(machine_id: int, amazon_data: dict):
-    """Update a machine with Amazon product data"""
+AMAZON_STAGE_COLUMNS = [
+    'id',
+    'amazon_asin',
+    'amazon_product_url',
+    'amazon_image_url',
+    'amazon_price_eur',
+    'amazon_product_title',
+]
+
+async def update_machines_amazon_data(conn, machines: list) -> int:
+    """Write Amazon product data for a batch of machines in a single UPDATE"""
+    rows = [m for m in machines if m.get('amazon_asin')]
+    if not rows:
+        return 0
+    
     try:
-        conn = get_connection(readonly=False)
-        
-        sql = """
-            UPDATE washing_machines 
-            SET 
-                amazon_asin = ?,
-                amazon_product_url = ?,
-                amazon_image_url = ?,
-                amazon_price_eur = ?,
-                amazon_product_title = ?,
-                amazon_last_checked = CURRENT_TIMESTAMP
-            WHERE id = ?
-        """
-        
-        conn.execute(sql, [
-            amazon_data.get('asin'),
-            amazon_data.get('product_url'),
-            amazon_data.get('image_url'),
-            amazon_data.get('price_eur'),
-            amazon_data.get('title'),
-            machine_id
-        ])
+        # Stage the batch as a DataFrame and join it in one statement instead of per-row UPDATEs
+        stage = pd.DataFrame(rows, columns=AMAZON_STAGE_COLUMNS)
+        conn.register("amz_stage", stage)
+        try:
+            conn.execute("""
+                UPDATE washing_machines AS w
+                SET 
+                    amazon_asin = s.amazon_asin,
+                    amazon_product_url = s.amazon_product_url,
+                    amazon_image_url = s.amazon_image_url,
+                    amazon_price_eur = s.amazon_price_eur,
+                    amazon_product_title = s.amazon_product_title,
+                    amazon_last_checked = CURRENT_TIMESTAMP
+                FROM amz_stage AS s
+                WHERE w.id = s.id
+            """)
+        finally:
+            conn.unregister("amz_stage")
         
         # Commit the transaction
         conn.commit()
         
-        logger.info(f"Updated machine {machine_id} with Amazon data: {amazon_data.get('asin')}")
+        logger.info(f"Updated {len(rows)} machines with Amazon data")
+        return len(rows)
         
     except Exception as e:
-        logger.error(f"Error updating machine {machine_id}: {e}")
-    finally:
-        conn.close()
+        logger.error(f"Error updating Amazon data for batch: {e}")
+        return 0
 
 async def enrich_amazon_data(batch_size: int = 10, max_machines: int = 100):
     """Main function to enrich washing machine data with Amazon information"""
@@ -124,34 +135,32 @@ async def enrich_amazon_data(batch_size: int = 10, max_machines: int = 100):
         logger.info("No machines found that need Amazon data enrichment")
         return
     
-    # Process in batches
-    for i in range(0, len(machines), batch_size):
-        batch = machines[i:i + batch_size]
-        logger.info(f"Processing batch {i//batch_size + 1}/{(len(machines) + batch_size - 1)//batch_size}")
+    # Updates go to a copy of the database that replaces the file when the run ends
+    # (the API keeps the file open, so it can't be written in place)
+    with write_connection() as conn:
+        # Previously seen (brand, model) pairs are answered from disk instead of amazon.fr
+        cache = AmazonLookupCache(conn)
         
-        async with AmazonProductLookup() as lookup:
-            enriched_batch = await lookup.batch_search_products(batch, max_concurrent=3)
-            
-            # Update database with results
-            for machine in enriched_batch:
-                if machine.get('amazon_asin'):
-                    # Create amazon_data dict from the machine data
-                    amazon_data = {
-                        'asin': machine.get('amazon_asin'),
-                        'product_url': machine.get('amazon_product_url'),
-                        'image_url': machine.get('amazon_image_url'),
-                        'price_eur': machine.get('amazon_price_eur'),
-                        'title': machine.get('amazon_product_title')
-                    }
-                    await update_machine_amazon_data(machine['id'], amazon_data)
+        # Process in batches
+        for i in range(0, len(machines), batch_size):
+            batch = machines[i:i + batch_size]
+            logger.info(f"Processing batch {i//batch_size + 1}/{(len(machines) + batch_size - 1)//batch_size}")
             
-            # Progress update
-            processed = min(i + batch_size, len(machines))
-            logger.info(f"Processed {processed}/{len(machines)} machines")
-            
-            # Small delay between batches
-            if i + batch_size < len(machines):
-                await asyncio.sleep(2)
+            async with AmazonProductLookup(cache=cache) as lookup:
+                enriched_batch, errors = await lookup.batch_search_products(batch)
+                if errors:
+                    logger.warning(f"{len(errors)} Amazon searches failed in this batch")
+                
+                # Update database with results
+                await update_machines_amazon_data(conn, enriched_batch)
+                
+                # Progress update
+                processed = min(i + batch_size, len(machines))
+                logger.info(f"Processed {processed}/{len(machines)} machines")
+                
+                # Small delay between batches
+                if i + batch_size < len(machines):
+                    await asyncio.sleep(2)
     
     logger.info("Amazon data enrichment completed!")
 
@@ -174,7 +183,10 @@ async def main():
             logger.info(f"  - {machine['nom_metteur_sur_le_marche']} {machine['nom_modele']}")
         return
     
-    await enrich_amazon_data(args.batch_size, args.max_machines)
+    try:
+        await enrich_amazon_data(args.batch_size, args.max_machines)
+    finally:
+        await close_session()
 
 if __name__ == "__main__":
     asyncio.run(main())
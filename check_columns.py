@@ -1,20 +1,24 @@
 #!/usr/bin/env python3
-import pandas as pd
+import duckdb
 import os
 
 csv_files = [f for f in os.listdir('/code/data/raw') if f.endswith('.csv')]
-df = pd.read_csv(f'/code/data/raw/{csv_files[0]}', sep=';', encoding='latin-1', nrows=5)
+# DuckDB's sniffer types each column from the sample, so the numeric check below
+# is a lookup instead of a per-value string test
+rel = duckdb.sql(
+    "SELECT * FROM read_csv(?, sep=';', encoding='latin-1', header=true, sample_size=5) LIMIT 5",
+    params=[f'/code/data/raw/{csv_files[0]}'],
+)
+first_row = rel.fetchone()
 
 print('Sample values from first few columns:')
-for col in df.columns[:10]:
-    print(f'{col}: {df[col].iloc[0]}')
+for col, val in list(zip(rel.columns, first_row))[:10]:
+    print(f'{col}: {val}')
 
 print('\nColumns that might contain numeric values:')
-numeric_cols = []
-for col in df.columns:
-    try:
-        if any(str(val).replace('.', '').isdigit() for val in df[col].head() if pd.notna(val)):
-            numeric_cols.append(col)
-    except:
-        pass
+numeric_types = {'TINYINT', 'SMALLINT', 'INTEGER', 'BIGINT', 'HUGEINT', 'FLOAT', 'DOUBLE'}
+numeric_cols = [
+    col for col, typ in zip(rel.columns, rel.dtypes)
+    if str(typ) in numeric_types or str(typ).startswith('DECIMAL')
+]
 print(numeric_cols[:10])
@@ -6,14 +6,14 @@ Downloads fresh data and creates a new database with Amazon product fields
 
 import os
 import sys
-import duckdb
-import pandas as pd
 from pathlib import Path
 
 # Add the backend directory to the Python path
 backend_dir = Path(__file__).parent / "backend"
 sys.path.insert(0, str(backend_dir))
 
+from app.duckdb_utils import refresh_brand_stats, refresh_search_columns, write_connection
+
 def download_washing_machine_data():
     """Download washing machine data from data.gouv.fr"""
     
@@ -67,11 +67,17 @@ def create_database_schema():
     )
     """
     
-    conn = duckdb.connect('backend/duckdb/washing_machines.duckdb')
-    conn.execute(schema_sql)
-    conn.close()
+    # Written through a copy swapped in on success, so it works while the API holds the file open
+    with write_connection('backend/duckdb/washing_machines.duckdb') as conn:
+        conn.execute(schema_sql)
     print("✅ Database schema created successfully")
 
+# Columns stored in their own fields; the rest of each row goes to additional_data
+ESSENTIAL_COLUMNS = {
+    'nom_modele', 'nom_metteur_sur_le_marche', 'note_reparabilite', 'note_fiabilite', 'note_id',
+    'id_unique', 'categorie_produit', 'date_calcul', 'url_tableau_detail_notation',
+}
+
 def load_data_to_database(downloaded_files):
     """Load the downloaded CSV files into the database"""
     
@@ -82,7 +88,13 @@ def load_data_to_database(downloaded_files):
     print(f"\n📊 Loading {len(downloaded_files)} CSV files into database...")
     
     db_path = "backend/duckdb/washing_machines.duckdb"
-    conn = duckdb.connect(db_path)
+    with write_connection(db_path) as conn:
+        total_rows = _load_files(conn, downloaded_files)
+    
+    print(f"\n✅ Total rows loaded: {total_rows}")
+
+def _load_files(conn, downloaded_files):
+    """Insert the consolidated CSV files through conn; returns the number of rows loaded"""
     
     total_rows = 0
     
@@ -96,109 +108,78 @@ def load_data_to_database(downloaded_files):
             continue
             
         try:
-            # Manual parsing of the consolidated CSV file
-            with open(filepath, 'r', encoding='latin-1') as f:
-                lines = f.readlines()
-            
-            if len(lines) < 2:
-                print(f"  ⚠️  File too short, skipping")
-                continue
-            
-            # Parse header (first line)
-            header_line = lines[0].strip()
-            column_names = [col.strip() for col in header_line.split(',')]
+            # DuckDB parses the file and fills the table in one INSERT ... SELECT;
+            # every value is read as text and converted in SQL, no per-row Python.
+            # Lines with extra fields are cut to the header width (strict_mode=false);
+            # short lines are rejected and counted (store_rejects) rather than loaded
+            source = (
+                "read_csv(?, sep=',', encoding='latin-1', header=true, all_varchar=true, "
+                "strict_mode=false, store_rejects=true)"
+            )
+            column_names = [row[0] for row in conn.execute(f"DESCRIBE SELECT * FROM {source}", [filepath]).fetchall()]
             print(f"  📋 Found {len(column_names)} columns")
             
-            # Parse data lines
-            data_rows = []
-            for i, line in enumerate(lines[1:], 1):
-                if line.strip():
-                    # Simple comma split (this file doesn't have quoted fields with commas)
-                    values = line.strip().split(',')
-                    if len(values) >= len(column_names):
-                        # Take only the columns we need
-                        row_data = values[:len(column_names)]
-                        data_rows.append(row_data)
-                    else:
-                        print(f"  ⚠️  Line {i} has {len(values)} values, expected {len(column_names)}")
+            # Clean column names (remove spaces, special chars)
+            clean_names = {col.strip().replace(' ', '_').replace('(', '').replace(')', ''): col for col in column_names}
             
-            print(f"  📁 Loaded {len(data_rows)} rows from CSV")
+            def quote(raw):
+                return '"' + raw.replace('"', '""') + '"'
             
-            # Create DataFrame
-            df = pd.DataFrame(data_rows, columns=column_names)
+            def column(name):
+                return quote(clean_names[name]) if name in clean_names else "NULL"
             
-            # Clean column names (remove spaces, special chars)
-            df.columns = [col.strip().replace(' ', '_').replace('(', '').replace(')', '') for col in df.columns]
+            # Every other non-empty column goes into additional_data as JSON
+            extra_entries = ", ".join(
+                "{'k': '" + name.replace("'", "''") + "', 'v': " + quote(raw) + "}"
+                for name, raw in clean_names.items()
+                if name not in ESSENTIAL_COLUMNS
+            )
+            extra = f"list_filter([{extra_entries}], e -> trim(e.v) <> '')" if extra_entries else "[]"
             
-            # Insert data into database
-            for idx, row in df.iterrows():
-                # Extract essential fields
-                nom_modele = row.get('nom_modele', None)
-                nom_metteur_sur_le_marche = row.get('nom_metteur_sur_le_marche', None)
-                note_reparabilite = row.get('note_reparabilite', None)
-                note_fiabilite = row.get('note_fiabilite', None)
-                note_id = row.get('note_id', None)
-                id_unique = row.get('id_unique', None)
-                categorie_produit = row.get('categorie_produit', None)
-                date_calcul = row.get('date_calcul', None)
-                url_tableau_detail_notation = row.get('url_tableau_detail_notation', None)
-                
-                # Convert numeric fields
-                try:
-                    note_reparabilite = float(note_reparabilite) if note_reparabilite else None
-                except:
-                    note_reparabilite = None
-                    
-                try:
-                    note_fiabilite = float(note_fiabilite) if note_fiabilite else None
-                except:
-                    note_fiabilite = None
-                    
-                try:
-                    note_id = float(note_id) if note_id else None
-                except:
-                    note_id = None
-                
-                # Store all other data as JSON
-                import json
-                additional_data = {}
-                for col in df.columns:
-                    if col not in ['nom_modele', 'nom_metteur_sur_le_marche', 'note_reparabilite', 'note_fiabilite', 'note_id', 'id_unique', 'categorie_produit', 'date_calcul', 'url_tableau_detail_notation']:
-                        value = row.get(col, None)
-                        if value is not None and str(value).strip() != '':
-                            additional_data[col] = value
-                
-                # Insert the row
-                insert_data = {
-                    'id': total_rows + 1,
-                    'nom_modele': nom_modele,
-                    'nom_metteur_sur_le_marche': nom_metteur_sur_le_marche,
-                    'note_reparabilite': note_reparabilite,
-                    'note_fiabilite': note_fiabilite,
-                    'note_id': note_id,
-                    'id_unique': id_unique,
-                    'categorie_produit': categorie_produit,
-                    'date_calcul': date_calcul,
-                    'url_tableau_detail_notation': url_tableau_detail_notation,
-                    'additional_data': json.dumps(additional_data) if additional_data else None
-                }
-                
-                columns = list(insert_data.keys())
-                values = list(insert_data.values())
-                placeholders = ', '.join(['?' for _ in values])
-                sql = f"INSERT INTO washing_machines ({', '.join(columns)}) VALUES ({placeholders})"
-                conn.execute(sql, values)
-                total_rows += 1
+            # The rejects tables accumulate per connection; start each file empty
+            conn.execute("DROP TABLE IF EXISTS reject_errors; DROP TABLE IF EXISTS reject_scans")
+            inserted = conn.execute(
+                f"""
+                INSERT INTO washing_machines (
+                    id, nom_modele, nom_metteur_sur_le_marche, note_reparabilite, note_fiabilite,
+                    note_id, id_unique, categorie_produit, date_calcul, url_tableau_detail_notation,
+                    additional_data
+                )
+                SELECT
+                    ? + row_number() OVER (),
+                    {column('nom_modele')},
+                    {column('nom_metteur_sur_le_marche')},
+                    TRY_CAST({column('note_reparabilite')} AS FLOAT),
+                    TRY_CAST({column('note_fiabilite')} AS FLOAT),
+                    TRY_CAST({column('note_id')} AS FLOAT),
+                    {column('id_unique')},
+                    {column('categorie_produit')},
+                    {column('date_calcul')},
+                    {column('url_tableau_detail_notation')},
+                    CASE WHEN len(extra) > 0 THEN to_json(map_from_entries(extra))::VARCHAR END
+                FROM (SELECT *, {extra} AS extra FROM {source})
+                """,
+                [total_rows, filepath],
+            ).fetchone()[0]
+            total_rows += inserted
             
-            print(f"  ✅ Inserted {len(df)} rows")
+            print(f"  ✅ Inserted {inserted} rows")
+            rejected = conn.execute("SELECT COUNT(DISTINCT line) FROM reject_errors").fetchone()[0]
+            if rejected:
+                print(f"  ⚠️  Skipped {rejected} malformed lines (e.g. fewer values than the header)")
             
         except Exception as e:
             print(f"  ❌ Error processing file: {e}")
             import traceback
             traceback.print_exc()
     
-    conn.close()
-    print(f"\n✅ Total rows loaded: {total_rows}")
+    if total_rows:
+        # Same post-load step as the ingest loader: /statistics ranks brands from
+        # wm_brand_stats, and search reads the lowercased columns
+        refresh_search_columns(conn)
+        refresh_brand_stats(conn)
+    
+    return total_rows
 
 def main():
     """Main function to rebuild the database"""
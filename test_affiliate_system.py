@@ -126,7 +126,8 @@ def test_affiliate_link_generation():
         lookup = AmazonProductLookup()
         
         # Test search URL generation
-        search_url = lookup._build_search_url("Samsung", "WF20DG8650BWU3")
+        base_url, params = lookup._build_search_url("Samsung", "WF20DG8650BWU3")
+        search_url = str(base_url.copy_merge_params(params))
         print(f"Search URL: {search_url}")
         
         if "lebrugere-21" in search_url:
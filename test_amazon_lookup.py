@@ -14,7 +14,7 @@ sys.path.insert(0, str(backend_dir))
 async def test_amazon_lookup():
     """Test the Amazon product lookup service"""
     try:
-        from app.amazon_lookup import AmazonProductLookup
+        from app.amazon_lookup import AmazonProductLookup, close_session
         
         print("Testing Amazon product lookup...")
         print("=" * 50)
@@ -46,6 +46,7 @@ async def test_amazon_lookup():
                 
                 # Small delay between requests
                 await asyncio.sleep(2)
+        await close_session()
         
         print("\n" + "=" * 50)
         print("Test completed!")